@@ -0,0 +1,8 @@
+# coding: utf-8
+"""
+Benchmarks of html_nested_tables on synthetic datadicts.
+
+Run ``python -m benchmarks`` from the root of the repository to compare
+the current code with ``benchmarks/baseline.json``,
+or ``python -m benchmarks --help`` for other options.
+"""
@@ -0,0 +1,216 @@
+# coding: utf-8
+
+from __future__ import unicode_literals, print_function
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import gc
+import json
+import os.path
+import sys
+import timeit
+import tracemalloc
+
+from html_nested_tables import (
+    OPTIMAL_STRUCTURES, build_optimal_table_dict, build_table_dict,
+    get_content_hash, get_optimal_structure)
+
+from .datasets import DATASETS, generate_datadict
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'baseline.json')
+PARALLEL_WORKERS = 4
+
+# Phases that must be faster than others on every dataset:
+# ``(phase, slower phases, minimum ratio)``.  A cache hit of ``RenderCache``
+# costs a content hash instead of building and rendering the table.
+CLAIMS = (
+    ('get_content_hash', ('build_table_dict', 'generate_html'), 3),
+)
+
+
+# Minimum duration of each timed sample, in seconds.  Fast phases are run
+# several times per sample, so that timer resolution and scheduling noise
+# are small compared to what is measured.
+MIN_SAMPLE_TIME = 0.1
+
+
+def calibrate():
+    """
+    Times a fixed pure Python workload.
+
+    Timings are stored as multiples of this, so that they can be compared
+    between machines and runs.  It is timed along each phase, so that
+    changes of the speed of the machine during a run cancel out.
+    """
+
+    d = {}
+    start = timeit.default_timer()
+    for i in range(20000):
+        d['%s' % i] = [i] * 3
+    ''.join(sorted(d))
+    return timeit.default_timer() - start
+
+
+def get_phases(datadict, executor):
+    """
+    Returns the benchmarked phases for ``datadict``.
+
+    Each phase is a ``(setup, function)`` pair:  ``setup`` is not timed,
+    and its result is passed to ``function``.  Tables are built in ``setup``
+    so that their caches are empty when ``function`` is timed.
+    ``executor`` is reused by parallel rendering, so that starting its
+    workers is not timed.  Memoized structures are forgotten before
+    timing the structure search.
+    """
+
+    structure = get_optimal_structure(datadict)
+
+    def build():
+        return build_table_dict(datadict, structure)
+
+    return (
+        ('build_table_dict', (lambda: None, lambda _: build())),
+        ('get_ugliness', (build, lambda table: table.get_ugliness())),
+        ('generate_html', (build, lambda table: table.generate_html())),
+        ('generate_html_parallel',
+         (build, lambda table: table.generate_html_parallel(
+             PARALLEL_WORKERS, executor))),
+        ('build_optimal_table_dict',
+         (OPTIMAL_STRUCTURES.clear,
+          lambda _: build_optimal_table_dict(datadict))),
+        ('get_content_hash',
+         (lambda: None, lambda _: get_content_hash(datadict, structure))),
+    )
+
+
+def time_once(setup, function):
+    arg = setup()
+    gc.collect()
+    start = timeit.default_timer()
+    function(arg)
+    return timeit.default_timer() - start
+
+
+def measure(setup, function, repeat):
+    """
+    Returns the best time of ``function`` per call out of ``repeat``
+    samples, the best time of :func:`calibrate` between these samples,
+    and the memory peak of ``function``.
+
+    Each sample runs ``function`` enough times to last at least
+    :data:`MIN_SAMPLE_TIME`.
+    """
+
+    number = int(MIN_SAMPLE_TIME // max(time_once(setup, function), 1e-6))
+    number = max(1, number)
+    times = []
+    units = []
+    for _ in range(repeat):
+        units.append(calibrate())
+        times.append(sum(time_once(setup, function)
+                         for _ in range(number)) / number)
+
+    arg = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(times), min(units), peak
+
+
+def run(repeat, names=None):
+    results = {}
+    with ThreadPoolExecutor(PARALLEL_WORKERS) as executor:
+        for name, kwargs in DATASETS:
+            if names and name not in names:
+                continue
+            datadict = generate_datadict(**kwargs)
+            for phase, (setup, function) in get_phases(datadict, executor):
+                seconds, unit, peak = measure(setup, function, repeat)
+                results['%s/%s' % (name, phase)] = {
+                    'time': seconds / unit, 'seconds': seconds,
+                    'memory': peak}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns the list of regressions of ``results`` against ``baseline``.
+
+    A phase regresses when its time or its memory peak is more than
+    ``tolerance`` times its baseline.
+    """
+
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        for metric in ('time', 'memory'):
+            ratio = result[metric] / (baseline[key][metric] or 1)
+            if ratio > tolerance:
+                regressions.append((key, metric, ratio))
+    return regressions
+
+
+def check_claims(results):
+    """
+    Returns the list of :data:`CLAIMS` that ``results`` do not meet.
+    """
+
+    failures = []
+    for name, _ in DATASETS:
+        for phase, slower_phases, minimum in CLAIMS:
+            keys = ['%s/%s' % (name, p) for p in (phase,) + slower_phases]
+            if not all(key in results for key in keys):
+                continue
+            ratio = (sum(results[key]['time'] for key in keys[1:])
+                     / results[keys[0]]['time'])
+            if ratio < minimum:
+                failures.append((keys[0], slower_phases, ratio))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description=__doc__)
+    parser.add_argument('datasets', nargs='*',
+                        help='Only run these datasets.')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='Maximum ratio against the baseline.')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true',
+                        help='Saves results as the new baseline.')
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat, args.datasets)
+    for key, result in sorted(results.items()):
+        print('%-40s %10.2f ms %10.1f KiB'
+              % (key, result['seconds'] * 1000, result['memory'] / 1024))
+    failures = check_claims(results)
+    for key, slower_phases, ratio in failures:
+        print('CLAIM %s is only %.2fx faster than %s'
+              % (key, ratio, ' + '.join(slower_phases)))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return 1 if failures else 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at %s, use --save to create it.' % args.baseline)
+        return 1 if failures else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    for key, metric, ratio in regressions:
+        print('REGRESSION %s %s: %.2fx the baseline' % (key, metric, ratio))
+    return 1 if regressions or failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+# coding: utf-8
+
+from __future__ import unicode_literals
+import random
+
+
+__all__ = ('generate_datadict', 'DATASETS')
+
+
+def generate_datadict(depth, fanout, mixed=0.0, sparsity=0.0, seed=0):
+    """
+    Generates a datadict made of nested association lists.
+
+    The same arguments always generate the same datadict.
+
+    :arg int depth: Maximum number of nested levels.
+    :arg int fanout: Number of keys per level.
+    :arg float mixed: Probability for a value above the last level to be
+                      a leaf, like in ``MixedLevelsTableTest``.
+    :arg float sparsity: Probability for a key to be missing.  Missing keys
+                         differ between siblings, so tables are sparse.
+    :arg int seed: Seed of the pseudo-random generator.
+    :returns: Nested association lists.
+    :rtype: tuple
+    """
+
+    rand = random.Random(seed)
+
+    def generate(level):
+        items = []
+        for i in range(fanout):
+            if items and rand.random() < sparsity:
+                continue
+            key = 'k%s-%s' % (level, i)
+            if level + 1 < depth and rand.random() >= mixed:
+                items.append((key, generate(level + 1)))
+            else:
+                items.append((key, rand.randint(0, 999)))
+        return tuple(items)
+
+    return generate(0)
+
+
+# Name: keyword arguments of ``generate_datadict``.
+DATASETS = (
+    ('wide', dict(depth=2, fanout=200)),
+    ('deep', dict(depth=8, fanout=3)),
+    ('report', dict(depth=4, fanout=8)),
+    ('mixed', dict(depth=5, fanout=5, mixed=0.3)),
+    ('sparse', dict(depth=4, fanout=9, sparsity=0.6)),
+)
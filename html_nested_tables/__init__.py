@@ -2,6 +2,10 @@
 
 from __future__ import unicode_literals
 from .base import *
+try:
+    from .aio import *
+except SyntaxError:  # Python < 3.6
+    pass
 
 
 __version__ = (0, 2, 0)
@@ -0,0 +1,65 @@
+# coding: utf-8
+
+"""
+Rendering tables from an :mod:`asyncio` event loop without blocking it.
+
+This module requires Python 3.6 or later.
+"""
+
+from __future__ import unicode_literals
+import asyncio
+from functools import partial
+
+from .base import build_optimal_table_dict
+
+
+__all__ = ('generate_html_async', 'build_optimal_table_dict_async')
+
+
+async def generate_html_async(table_dict, cells=1000, offload=False,
+                              executor=None, cell_format=None):
+    """
+    See :meth:`TableDict.generate_html_async`.
+    """
+
+    if cells < 1:
+        raise ValueError('`cells` must be a positive integer.')
+    loop = asyncio.get_running_loop()
+
+    async def call(function, *args):
+        if offload:
+            return await loop.run_in_executor(executor,
+                                              partial(function, *args))
+        return function(*args)
+
+    layout = await call(table_dict._layout, cell_format)
+    formatters = layout._get_formatters(cell_format)
+    for chunk in layout.header_rows:
+        yield chunk
+        await asyncio.sleep(0)
+    # Data is extracted a band of rows at a time.
+    for first_row, last_row in table_dict._get_band_bounds(layout):
+        data = await call(table_dict._get_data_band, layout, first_row,
+                          last_row)
+        band = first_row, last_row, data
+        for chunk in layout._iter_html_cells(band, cells, formatters):
+            yield chunk
+            await asyncio.sleep(0)
+    yield layout.footer
+
+
+async def build_optimal_table_dict_async(datadict, key=None, workers=None,
+                                         executor=None):
+    """
+    Same as :func:`build_optimal_table_dict`, running the structure search
+    and the build in ``executor`` so that the event loop stays responsive.
+
+    :arg executor: By default, the executor of the event loop.  With a
+                   :class:`concurrent.futures.ProcessPoolExecutor`,
+                   ``datadict`` and ``key`` must be picklable.
+    :type executor: concurrent.futures.Executor or None
+    :rtype: HorizontalTableDict or VerticalTableDict
+    """
+
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, partial(build_optimal_table_dict, datadict, key, workers))
@@ -1,14 +1,43 @@
 # coding: utf-8
 
 from __future__ import unicode_literals, division
-from collections import OrderedDict
-from itertools import product
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, deque
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+try:
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+except ImportError:  # Python 2 without the ``futures`` backport
+    ProcessPoolExecutor = ThreadPoolExecutor = None
+from contextlib import contextmanager
+from functools import partial
+import hashlib
+from itertools import chain, product
+import json
+import math
+import os
+import pickle
+import sys
+import threading
+from timeit import default_timer
+import weakref
 
 
 __all__ = (
     'HORIZONTAL', 'VERTICAL',
-    'TableDict', 'HorizontalTableDict', 'VerticalTableDict', 'h', 'v',
-    'get_all_structures', 'build_table_dict', 'build_optimal_table_dict',
+    'BaseTableDict', 'TableDict', 'HorizontalTableDict', 'VerticalTableDict',
+    'h', 'v', 'TableDictView', 'CompactTableDict', 'CellFormat',
+    'TableLayout', 'compile_layout', 'Stats',
+    'get_all_structures', 'get_optimal_structure', 'build_table_dict',
+    'StructureMemo', 'OPTIMAL_STRUCTURES',
+    'build_optimal_table_dict', 'build_table_view', 'build_optimal_table_view',
+    'build_compact_table_dict', 'build_table_dict_from_records',
+    'DiskTableDict', 'build_disk_table_dict',
+    'get_shape_fingerprint', 'get_content_hash',
+    'render_many', 'render_many_iter', 'RenderCache', 'render_array',
 )
 
 
@@ -16,36 +45,154 @@ HORIZONTAL = 'horizontal'
 VERTICAL = 'vertical'
 
 
+class Stats(object):
+    """
+    Records where time is spent while building and rendering tables.
+
+    Pass it as ``stats`` to :func:`build_table_dict`,
+    :func:`build_optimal_table_dict` or :meth:`TableDict.generate_html`.
+    Phases are:
+
+    - ``'structure_search'``: choosing the optimal structure;
+    - ``'build'``: building :class:`TableDict` s from a datadict;
+    - ``'headers'``: building nested header lists;
+    - ``'layout'``: computing accessors, spans and header HTML;
+    - ``'data'``: extracting data cells;
+    - ``'html'``: serializing HTML.  Data is extracted a band of rows at
+      a time while serializing, so this includes the ``'data'`` phase.
+
+    Cached phases are nearly instantaneous.
+
+    :ivar dict times: Total seconds spent in each phase.
+    :ivar dict calls: Number of times each phase was run.
+    :ivar dict counts: ``'candidates'`` (structures evaluated), ``'rows'``,
+                       ``'columns'`` and ``'cells'`` of rendered tables.
+    :arg callback: Called with the phase name and its duration in seconds
+                   at the end of each phase.
+    :type callback: callable or None
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.times = {}
+        self.calls = {}
+        self.counts = {}
+
+    @contextmanager
+    def timer(self, phase):
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.add_time(phase, default_timer() - start)
+
+    def add_time(self, phase, seconds, calls=1):
+        self.times[phase] = self.times.get(phase, 0) + seconds
+        self.calls[phase] = self.calls.get(phase, 0) + calls
+        if self.callback is not None:
+            self.callback(phase, seconds)
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def timed_iter(self, phase, iterable):
+        """
+        Yields from ``iterable``, adding the time spent in it to ``phase``.
+        """
+
+        iterator = iter(iterable)
+        seconds = 0
+        try:
+            while True:
+                start = default_timer()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    seconds += default_timer() - start
+                yield item
+        finally:
+            self.add_time(phase, seconds)
+
+    def __repr__(self):
+        return '<Stats %s>' % ', '.join(
+            '%s: %.6fs (%s)' % (phase, self.times[phase], self.calls[phase])
+            for phase in sorted(self.times))
+
+
 def build_tag(name, props, content):
     props_str = ' '.join('%s="%s"' % (k, v) for k, v in props.items())
     return '<%s %s>%s</%s>' % (name, props_str, content, name)
 
 
-class TableDict(OrderedDict):
+# Merged headers are searched in a list up to this length, in a set after.
+_MAX_SEARCHED_HEADERS = 8
+
+
+def _get_nesting_depth(l):
+    # Taken from http://stackoverflow.com/a/6039138/1576438
+    return (isinstance(l, (list, tuple, dict))
+            and max(map(_get_nesting_depth, l)) + 1)
+
+
+class _HeaderGroup(list):
     """
-    TableDict objects are ordered dicts with methods that renders HTML tables.
+    A ``[header, group]`` item of nested headers, with a hash.
 
-    Here is an ugly schema to define the terms I’m using:
+    It is equal to the same plain list, but it can be put in a set.
+    The hash is computed the first time it is needed, from the hashes of
+    the items of ``group``, so that merging headers is linear instead of
+    quadratic.  Build it with ``_HeaderGroup((header, group))``, which
+    only runs the constructor of ``list``.
+    """
 
-    +---------+-------------+-------------+-------------+-------------+
-    |         |     hh1     |     hh2     |     hh3     |     hh4     |
-    |         +------+------+------+------+------+------+------+------+
-    |         | hh11 | hh12 | hh21 | hh22 | hh31 | hh32 | hh41 | hh42 |
-    +=========+======+======+======+======+======+======+======+======+
-    | **vh1** |  dA  |  dB  |  dC  |  dE  |  dF  |  dG  |  dH  |  dI  |
-    +---------+------+------+------+------+------+------+------+------+
-    | **vh2** |  dJ  |  dK  |  dL  |  dM  |  dN  |  dO  |  dP  |  dQ  |
-    +---------+------+------+------+------+------+------+------+------+
-    | **vh3** |  dR  |  dS  |  dT  |  dU  |  dV  |  dW  |  dX  |  dY  |
-    +---------+------+------+------+------+------+------+------+------+
+    __slots__ = ('_hash',)
 
-    `hh1`, `hh11`, `hh2` […] are horizontal headers,
-    `vh1`, `vh2`, […] are vertical headers,
-    and `dA`, `dB`, […] are data.
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            header, group = self
+            value = self._hash = hash((header,) + tuple(map(hash, group)))
+            return value
+
+
+class BaseTableDict(object):
+    """
+    Methods rendering HTML tables from nested mappings.
+
+    Subclasses are mappings whose ``items`` and ``__getitem__`` return nested
+    :class:`BaseTableDict` s or data.  They also have a ``direction`` and,
+    for the outermost one, a ``structure``.  See :class:`TableDict`
+    for the terms used.
     """
 
+    __slots__ = ()
+
     structure = ()
     direction = None
+    # Number of rows extracted at a time when rendering.
+    rows_per_band = 1000
+
+    # Per-instance cache, created lazily so that ``OrderedDict``
+    # can call ``__setitem__`` before ``__init__`` is over.
+    _cache = None
+
+    def _cached(self, key, function, *args):
+        """
+        Returns the cached result of ``function(*args)`` stored under ``key``.
+
+        Mutable subclasses must empty it when they are modified.
+        """
+
+        if self._cache is None:
+            self._cache = {}
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = function(*args)
+            return value
 
     def _get_headers(self, side):
         """
@@ -65,29 +212,74 @@ class TableDict(OrderedDict):
         :rtype: list
         """
 
-        DictClass = {HORIZONTAL: HorizontalTableDict,
-                     VERTICAL: VerticalTableDict}[side]
         headers = []
-        for k, v in self.items():
-            if isinstance(v, TableDict):
-                child_headers = getattr(v, side + '_headers')()
-                if child_headers:
-                    if isinstance(self, DictClass):
-                        headers.append([k, child_headers])
-                    else:
-                        for h in child_headers:
-                            if h not in headers:
-                                headers.append(h)
-                    continue
-            if isinstance(self, DictClass) and k not in headers:
+        if self.direction == side:
+            # Keys are unique, there is nothing to merge.
+            for k, v in self._header_items():
+                if isinstance(v, BaseTableDict):
+                    child_headers = v._nested_headers(side)
+                    if child_headers:
+                        headers.append(_HeaderGroup((k, child_headers)))
+                        continue
                 headers.append(k)
+            return headers
+
+        # Headers of children are merged, skipping duplicates.  Short lists
+        # are searched, which is faster than hashing nested groups.  Once
+        # ``headers`` is long, ``seen`` holds the same headers to find
+        # duplicates in constant time.
+        seen = None
+        for k, v in self._header_items():
+            if not isinstance(v, BaseTableDict):
+                continue
+            for h in v._nested_headers(side):
+                if seen is None:
+                    if h in headers:
+                        continue
+                    headers.append(h)
+                    if len(headers) > _MAX_SEARCHED_HEADERS:
+                        seen = set(headers)
+                elif h not in seen:
+                    seen.add(h)
+                    headers.append(h)
         return headers
 
+    def _nested_headers(self, side):
+        """
+        Returns the headers of ``self`` when it is nested in another table.
+        """
+
+        return self._cached(side, self._get_headers, side)
+
+    def _header_items(self):
+        """
+        Returns the ``(key, value)`` pairs used to compute headers.
+        Only values that are tables matter.
+        """
+
+        return self.items()
+
+    def _items_in(self, keys):
+        """
+        Returns the ``(key, value)`` pairs of ``self`` whose key is in
+        ``keys``.
+
+        Items are walked instead of looking up each key, since mapping-backed
+        subclasses index their keys on the first lookup.
+        """
+
+        return ((k, v) for k, v in self.items() if k in keys)
+
     def horizontal_headers(self):
-        return self._get_headers(HORIZONTAL)
+        return self._cached(HORIZONTAL, self._get_headers, HORIZONTAL)
 
     def vertical_headers(self):
-        return self._get_headers(VERTICAL)
+        return self._cached(VERTICAL, self._get_headers, VERTICAL)
+
+    def _headers_length(self, side):
+        return self._cached(
+            ('length', side), self._get_final_length,
+            getattr(self, side + '_headers')())
 
     @staticmethod
     def _get_headers_depth(headers):
@@ -109,13 +301,9 @@ class TableDict(OrderedDict):
         3
         """
 
-        # Taken from http://stackoverflow.com/a/6039138/1576438
-        def max_depth(l):
-            return isinstance(l, (list, tuple, dict)) and max(map(max_depth, l)) + 1
-
         if not headers:
             return 1
-        d = max_depth(headers)
+        d = _get_nesting_depth(headers)
         return d - d // 2
 
     @classmethod
@@ -133,14 +321,42 @@ class TableDict(OrderedDict):
 
         total = 0
         for item in l:
-            if isinstance(item, (list, tuple)):
+            if isinstance(item, list):
                 header, group = item
                 total += cls._get_final_length(group)
             else:
                 total += 1
         return total
 
-    def _horizontal_header_iterator(self, headers=None, depth=0):
+    @classmethod
+    def _get_group_lengths(cls, headers, lengths):
+        """
+        Same as :meth:`_get_final_length`, but also stores the final length
+        of each nested group in ``lengths``, indexed by the group ``id``.
+
+        This computes all colspans and rowspans in a single pass.
+
+        >>> lengths = {}
+        >>> TableDict._get_group_lengths([['a', [1, 2, 3]], 'b'], lengths)
+        4
+        >>> sorted(lengths.values())
+        [3]
+        """
+
+        total = 0
+        for item in headers:
+            if isinstance(item, list):
+                header, group = item
+                length = lengths[id(group)] = cls._get_group_lengths(
+                    group, lengths)
+                total += length
+            else:
+                total += 1
+        return total
+
+    @classmethod
+    def _horizontal_header_iterator(cls, headers, max_depth, lengths,
+                                    depth=0):
         """
         Returns a generator that iterates over horizontal headers.
 
@@ -148,13 +364,11 @@ class TableDict(OrderedDict):
         """
 
         to_be_explored = []
-        headers = headers or self.horizontal_headers()
-        max_depth = self._get_headers_depth(self.horizontal_headers())
         for item in headers:
             group = None
             if isinstance(item, list):
                 header, group = item
-                props = {'colspan': self._get_final_length(group)}
+                props = {'colspan': lengths[id(group)]}
                 to_be_explored.extend(group)
             else:
                 header = item
@@ -164,24 +378,23 @@ class TableDict(OrderedDict):
             yield header, depth, props, not group
         if to_be_explored:
             for subheader, subdepth, subprops, is_leaf \
-                in self._horizontal_header_iterator(
-                    to_be_explored, depth + 1):
+                in cls._horizontal_header_iterator(
+                    to_be_explored, max_depth, lengths, depth + 1):
                 yield subheader, subdepth, subprops, is_leaf
 
-    def _vertical_header_iterator(self, headers=None, depth=0):
+    @classmethod
+    def _vertical_header_iterator(cls, headers, max_depth, lengths, depth=0):
         """
         Returns a generator that iterates over vertical headers.
 
         This is designed to ease HTML generation.
         """
 
-        headers = headers or self.vertical_headers()
-        max_depth = self._get_headers_depth(self.vertical_headers())
         for item in headers:
             group = None
             if isinstance(item, list):
                 header, group = item
-                props = {'rowspan': self._get_final_length(group)}
+                props = {'rowspan': lengths[id(group)]}
             else:
                 header = item
                 props = {}
@@ -190,10 +403,12 @@ class TableDict(OrderedDict):
             yield header, depth, props, not group
             if group:
                 for subheader, subdepth, subprops, is_leaf \
-                        in self._vertical_header_iterator(group, depth + 1):
+                        in cls._vertical_header_iterator(
+                            group, max_depth, lengths, depth + 1):
                     yield subheader, subdepth, subprops, is_leaf
 
-    def _accessors_iterator(self, headers, parent_accessors=()):
+    @classmethod
+    def _accessors_iterator(cls, headers, parent_accessors=()):
         """
         Returns a generator that allows to iterate over accessors to pieces of
         data.
@@ -211,68 +426,238 @@ class TableDict(OrderedDict):
         for accessor in headers:
             if isinstance(accessor, list):
                 header, group = accessor
-                for sub_accessor in self._accessors_iterator(
+                for sub_accessor in cls._accessors_iterator(
                         group, parent_accessors + (header,)):
                     yield sub_accessor
             else:
                 yield parent_accessors + (accessor,)
 
     def _horizontal_accessors(self):
-        if not hasattr(self, '__horizontal_accessors'):
-            self.__horizontal_accessors = list(
-                self._accessors_iterator(self.horizontal_headers()))
-        return self.__horizontal_accessors
+        return self._layout().horizontal_accessors
 
     def _vertical_accessors(self):
-        if not hasattr(self, '__vertical_accessors'):
-            self.__vertical_accessors = list(
-                self._accessors_iterator(self.vertical_headers()))
-        return self.__vertical_accessors
+        return self._layout().vertical_accessors
+
+    def _layout(self, cell_format=None):
+        format_header = _get_header_formatter(cell_format)
+        if format_header is None:
+            return self._cached(
+                ('layout', tuple(self.structure)),
+                lambda: TableLayout(self.structure, self.horizontal_headers(),
+                                    self.vertical_headers()))
+        header_key = cell_format._get_header_key()
+
+        def get_layout():
+            return TableLayout(self.structure, self.horizontal_headers(),
+                               self.vertical_headers(), format_header)
+
+        if header_key == 'escaped':
+            # Usually, headers only depend on ``escape``, so there is a
+            # single layout with escaped headers per structure, whatever
+            # the ``CellFormat``.
+            return self._cached(
+                ('layout', tuple(self.structure), header_key), get_layout)
+        # Custom header formatters may depend on anything, only the layout
+        # of the last class and settings is kept.
+        key = ('layout', tuple(self.structure), 'format_header')
+        cached = self._cached(key, lambda: (header_key, get_layout()))
+        if cached[0] != header_key:
+            cached = self._cache[key] = header_key, get_layout()
+        return cached[1]
 
-    def _data_iterator(self):
+    def _get_data(self):
         """
-        Returns a generator that iterates over data.
+        Returns the flat, row-major list of data cells of ``self``.
 
-        This is designed to ease HTML generation.
+        Empty cells are ``None``.
         """
 
-        def inner_generator(vertical_accessor, horizontal_accessor):
-            v = self
-            x, y = 0, 0
-            for table_class in self.structure:
-                try:
-                    if table_class.direction == HORIZONTAL:
-                        accessor = horizontal_accessor[x]
-                        x += 1
-                    else:
-                        accessor = vertical_accessor[y]
-                        y += 1
-                except IndexError:
-                    break
-                try:
-                    v = v[accessor]
-                except (TypeError, KeyError):
-                    return
+        # ``structure`` is a plain attribute, so it is part of the key.
+        # It may be a list, hence the ``tuple``.
+        return self._cached(('data', tuple(self.structure)),
+                            self._layout().get_data, self)
 
-            if isinstance(v, TableDict):
-                return
+    def _get_cached_data(self):
+        """
+        Returns the data of :meth:`_get_data` if it is cached, or ``None``.
+        """
+
+        return self._cache and self._cache.get(('data', tuple(self.structure)))
 
-            return v
+    def _get_band_bounds(self, layout):
+        """
+        Returns the ``(first_row, last_row)`` of the bands of rows in which
+        data is extracted when rendering with ``layout``, ``rows_per_band``
+        rows at a time, or all at once if data is cached.
+        """
 
-        vertical_accessors = self._vertical_accessors() or (None,)
-        horizontal_accessors = self._horizontal_accessors() or (None,)
-        for vertical_accessor in vertical_accessors:
-            for horizontal_accessor in horizontal_accessors:
-                yield inner_generator(vertical_accessor, horizontal_accessor)
+        row_count = len(layout.row_prefixes)
+        if self._get_cached_data() is not None:
+            return [(0, row_count)]
+        return [(first_row, min(first_row + self.rows_per_band, row_count))
+                for first_row in range(0, row_count, self.rows_per_band)]
 
-    def _get_data(self):
-        if not hasattr(self, '__data'):
-            self.__data = list(self._data_iterator())
-        return self.__data
+    def _get_data_band(self, layout, first_row, last_row):
+        """
+        Returns the flat, row-major list of data cells of ``self`` from row
+        ``first_row`` to row ``last_row`` excluded.
 
-    def generate_html(self):
+        It is not cached.
         """
-        Generates an HTML table from the contents of ``self``.
+
+        data = self._get_cached_data()
+        if data is None:
+            return layout._get_data_band(self, first_row, last_row)
+        if first_row == 0 and last_row == len(layout.row_prefixes):
+            return data
+        width = layout.width
+        return data[first_row * width:last_row * width]
+
+    def _iter_data_bands(self, layout):
+        """
+        Yields the ``(first_row, last_row, data)`` of the bands of
+        :meth:`_get_band_bounds`.
+        """
+
+        for first_row, last_row in self._get_band_bounds(layout):
+            yield first_row, last_row, self._get_data_band(
+                layout, first_row, last_row)
+
+    def _get_parallel_bands(self, layout, count):
+        """
+        Returns the ``(first_row, last_row)`` of the bands rendered
+        in parallel, about ``count`` of them.
+        """
+
+        return layout._get_bands(count)
+
+    def _iter_sparse_cells(self, layout):
+        """
+        Returns the ``((row, column), d)`` of the data cells that are not
+        empty, in row-major order.
+        """
+
+        # Stored as data, so that it is dropped when data changes.
+        return self._cached(('data', 'sparse', tuple(self.structure)),
+                            self._get_sparse_cells)
+
+    def _get_accessor_indexes(self, side):
+        """
+        Returns a dict of the indexes of the accessors of ``side``
+        starting with each possible prefix.
+        """
+
+        accessors = getattr(self._layout(), side + '_accessors') or ((),)
+        indexes = {}
+        for i, accessor in enumerate(accessors):
+            for length in range(len(accessor) + 1):
+                indexes.setdefault(accessor[:length], []).append(i)
+        return indexes
+
+    def _get_matching_accessors(self, side, prefix, exact):
+        indexes = self._cached(('accessor_indexes', side,
+                                tuple(self.structure)),
+                               self._get_accessor_indexes, side)
+        matching = indexes.get(prefix, ())
+        if exact:
+            accessors = getattr(self._layout(), side + '_accessors') or ((),)
+            matching = [i for i in matching
+                        if len(accessors[i]) == len(prefix)]
+        return matching
+
+    def _get_cells(self, path):
+        """
+        Returns the ``(row, column)`` of the cells displaying the leaf
+        at ``path``.
+
+        These are the cells whose accessors lead to that leaf, following
+        the same rules as :meth:`TableLayout._fill_cells`.
+        """
+
+        structure = tuple(self.structure)
+        if len(path) > len(structure):
+            return []
+        vertical_path = tuple(k for k, table_class in zip(path, structure)
+                              if table_class.direction == VERTICAL)
+        horizontal_path = tuple(k for k, table_class in zip(path, structure)
+                                if table_class.direction == HORIZONTAL)
+        next_direction = (structure[len(path)].direction
+                          if len(path) < len(structure) else None)
+        rows = self._get_matching_accessors(
+            VERTICAL, vertical_path, next_direction == VERTICAL)
+        columns = self._get_matching_accessors(
+            HORIZONTAL, horizontal_path, next_direction == HORIZONTAL)
+        return [(row, column) for row in rows for column in columns]
+
+    def _get_sparse_cells(self):
+        """
+        Returns the ``((row, column), data)`` of the cells with data,
+        sorted by row and column.
+
+        Only the leaves of ``self`` are visited, so it costs about the number
+        of leaves, instead of the number of cells of the table.
+        """
+
+        cells = {}
+
+        def walk(node, path):
+            for k, value in node.items():
+                if isinstance(value, BaseTableDict):
+                    walk(value, path + (k,))
+                elif value is not None:
+                    for cell in self._get_cells(path + (k,)):
+                        cells[cell] = value
+
+        walk(self, ())
+        return sorted(cells.items(), key=lambda item: item[0])
+
+    def generate_html_sparse(self, compress=False, cell_format=None):
+        """
+        Same as :meth:`generate_html`, for tables with mostly empty cells.
+
+        Data is extracted from the leaves of ``self`` instead of looking up
+        every cell, and runs of empty cells are written at once.
+
+        :arg compress: Renders each run of empty cells as a single cell
+                       with a colspan.  The table then looks the same, with
+                       a much smaller HTML.
+        :type compress: bool
+        :arg cell_format: See :meth:`generate_html_iter`.
+        :type cell_format: CellFormat or None
+        :returns: A HTML table.
+        :rtype: unicode
+        """
+
+        layout = self._layout(cell_format)
+        formatters = layout._get_formatters(cell_format)
+        cells = iter(self._iter_sparse_cells(layout))
+        missing = '-' if cell_format is None else cell_format.missing
+        empty_cell = '<td>%s</td>' % missing
+
+        def empty_cells(count):
+            if compress and count > 1:
+                return '<td colspan="%s">%s</td>' % (count, missing)
+            return empty_cell * count
+
+        out = list(layout.header_rows)
+        cell = next(cells, None)
+        for row, prefix in enumerate(layout.row_prefixes):
+            out.append(prefix)
+            next_column = 0
+            while cell is not None and cell[0][0] == row:
+                (_, column), d = cell
+                out.append(empty_cells(column - next_column))
+                out.append(_render_cells(
+                    (d,), formatters and formatters[column:column + 1]))
+                next_column = column + 1
+                cell = next(cells, None)
+            out.append(empty_cells(layout.width - next_column))
+        out.append(layout.footer)
+        return ''.join(out)
+
+    def generate_html_iter(self, stats=None, cell_format=None):
+        """
+        Generates an HTML table from the contents of ``self``, row by row.
 
         It creates an empty cell first, adds horizontal headers, then adds both
         vertical headers and data in the same time.
@@ -281,58 +666,188 @@ class TableDict(OrderedDict):
         outstanding inplace modification possibilities.  That may be much more
         readable, but also much slower.
 
+        :arg stats: Records the time spent in each rendering phase.
+        :type stats: Stats or None
+        :arg cell_format: How headers and data are converted to HTML.
+                          By default, they are inserted as is.
+        :type cell_format: CellFormat or None
+        :returns: A generator of HTML chunks, one per table row.  Joined
+                  together, they are equal to :meth:`generate_html`.
+                  Data is extracted ``rows_per_band`` rows at a time
+                  as chunks are generated, and is not kept.
+        :rtype: generator of unicode
+        """
+
+        if stats is None:
+            layout = self._layout(cell_format)
+            return layout._iter_html_bands(self._iter_data_bands(layout),
+                                           cell_format)
+
+        with stats.timer('headers'):
+            self.horizontal_headers()
+            self.vertical_headers()
+        with stats.timer('layout'):
+            layout = self._layout(cell_format)
+        stats.count('rows', len(layout.row_prefixes))
+        stats.count('columns', layout.width)
+        stats.count('cells', len(layout.row_prefixes) * layout.width)
+        return stats.timed_iter('html', layout._iter_html_bands(
+            stats.timed_iter('data', self._iter_data_bands(layout)),
+            cell_format))
+
+    def generate_html(self, stats=None, cell_format=None):
+        """
+        Generates an HTML table from the contents of ``self``.
+
+        See :meth:`generate_html_iter`.
+
         :returns: A HTML table.
         :rtype: unicode
         """
 
-        horizontal_headers = self.horizontal_headers()
-        vertical_headers = self.vertical_headers()
+        return ''.join(self.generate_html_iter(stats, cell_format))
 
-        out = '<table>'
-        if horizontal_headers:
-            out += '<tr>'
-            if vertical_headers:
-                # Creates the top left empty cell.
-                out += '<td colspan="%s" rowspan="%s" ' \
-                       'style="border: none;"></td>' \
-                    % (self._get_headers_depth(vertical_headers),
-                       self._get_headers_depth(horizontal_headers))
-            # Creates horizontal headers.
-            previous_depth = 0
-            for header, depth, props, is_leaf \
-                    in self._horizontal_header_iterator(horizontal_headers):
-                if depth != previous_depth:
-                    out += '</tr><tr>'
-                    previous_depth = depth
-                out += build_tag('th', props, header)
+    def generate_html_parallel(self, workers=None, executor=None,
+                               cell_format=None):
+        """
+        Same as :meth:`generate_html`, rendering bands of rows in parallel.
+
+        Bands are made of whole top-level vertical header groups, so rows
+        of a group are rendered together.  Data is extracted once, except
+        for tables larger than memory, then each band is rendered in
+        ``executor`` from its row headers and data, and bands are joined
+        in order.
+
+        Without ``executor``, bands are rendered in a pool of
+        :func:`os.cpu_count` workers shared by all calls, started by the
+        first one.  On free-threaded builds of Python, it is a
+        :class:`concurrent.futures.ThreadPoolExecutor`.  Elsewhere, the GIL
+        serializes threads, so it is a
+        :class:`concurrent.futures.ProcessPoolExecutor`: rows are then
+        pickled, so it only pays off for large tables, and data must be
+        picklable.
+
+        :arg workers: Rows are split in about ``4 * workers`` bands,
+                      by default ``4 * os.cpu_count()``.
+        :type workers: int or None
+        :arg executor: Executor rendering bands, by default the shared pool.
+        :type executor: concurrent.futures.Executor or None
+        :arg cell_format: See :meth:`generate_html_iter`.  It must be
+                          picklable when using processes.
+        :type cell_format: CellFormat or None
+        :returns: A HTML table.
+        :rtype: unicode
+        """
 
-        horizontal_length = self._get_final_length(horizontal_headers) or 1
+        layout = self._layout(cell_format)
+        if executor is None:
+            executor = _get_parallel_executor()
+        return layout._render_parallel(
+            self, executor, (workers or os.cpu_count() or 1) * 4, cell_format)
 
-        def display_data(data_index=0):
-            out = ''
-            for data in self._get_data()[
-                    horizontal_length * data_index:
-                    horizontal_length * (data_index + 1)]:
-                out += '<td>%s</td>' % ('-' if data is None else data)
-            return out
+    def generate_html_async(self, cells=1000, offload=False, executor=None,
+                            cell_format=None):
+        """
+        Same as :meth:`generate_html_iter`, as an asynchronous iterator that
+        gives control back to the event loop every ``cells`` data cells.
+
+        Requires Python 3.6 or later.
+
+        :arg cells: Number of data cells per chunk.
+        :type cells: int
+        :arg offload: Extracts the headers and data in ``executor``
+                      instead of blocking the event loop.
+        :type offload: bool
+        :arg executor: Executor used when ``offload`` is true, by default
+                       the one of the event loop.
+        :type executor: concurrent.futures.Executor or None
+        :arg cell_format: See :meth:`generate_html_iter`.
+        :type cell_format: CellFormat or None
+        :returns: An asynchronous iterator of HTML chunks.  Joined together,
+                  they are equal to :meth:`generate_html`.
+        :rtype: async generator of unicode
+        """
 
-        # Creates lines of vertical headers and data.
-        if vertical_headers:
-            previous_depth = 0
-            data_index = -1
-            for header, depth, props, is_leaf \
-                    in self._vertical_header_iterator(vertical_headers):
-                if depth <= previous_depth:
-                    out += '</tr><tr>'
-                    data_index += 1
-                out += build_tag('th', props, header)
-                if is_leaf:
-                    out += display_data(data_index)
-                previous_depth = depth
-        else:
-            out += '</tr><tr>' + display_data() + '</tr>'
-        out += '</table>'
-        return out
+        from .aio import generate_html_async
+        return generate_html_async(self, cells, offload, executor,
+                                   cell_format)
+
+    def get_grid(self):
+        """
+        Exports ``self`` as a compact grid, to be rendered client-side.
+
+        Headers are ``[header, colspan, rowspan]`` lists, with the same spans
+        as :meth:`generate_html`.  ``horizontal_headers`` has one list per
+        header row, ``vertical_headers`` has one list per data row, of the
+        headers starting at that row.  ``corner`` is the
+        ``[colspan, rowspan]`` of the top left empty cell, if any.  ``data``
+        is row-major, ``None`` for empty cells.  Headers and data that are
+        not JSON types are converted to strings, NaN and infinite floats
+        to ``None``.
+
+        >>> table = build_table_dict(((1, (('a', 2.5), ('b', 3))),), (v, h))
+        >>> grid = table.get_grid()
+        >>> grid['horizontal_headers'], grid['vertical_headers']
+        ([[['a', 1, 1], ['b', 1, 1]]], [[[1, 1, 1]]])
+        >>> grid['corner'], grid['data']
+        ([1, 1], [2.5, 3])
+
+        :returns: A dict with ``width``, ``height``, ``corner``,
+                  ``horizontal_headers``, ``vertical_headers`` and ``data``.
+        :rtype: dict
+        """
+
+        layout = self._layout()
+        return layout._get_grid(self._iter_data_bands(layout))
+
+    def generate_json(self):
+        """
+        Returns :meth:`get_grid` as compact JSON.
+
+        :rtype: unicode
+        """
+
+        layout = self._layout()
+        return ''.join(layout._iter_json(self._iter_data_bands(layout)))
+
+    def generate_html_window(self, rows=None, columns=None,
+                             cell_format=None):
+        """
+        Generates the HTML table of a range of rows and columns of ``self``.
+
+        Horizontal headers are always included, and vertical headers of the
+        rows in the window.  Headers partially outside the window have their
+        colspan or rowspan reduced to the window.  Only the data of the window
+        is extracted, so it costs about the size of the window, not the size
+        of the table.  The whole window is the same as :meth:`generate_html`.
+
+        :arg rows: Rows of data to render, e.g. ``slice(10000, 10100)``.
+        :type rows: slice or None
+        :arg columns: Columns of data to render.
+        :type columns: slice or None
+        :arg cell_format: See :meth:`generate_html_iter`.
+        :type cell_format: CellFormat or None
+        :returns: A HTML table.
+        :rtype: unicode
+        """
+
+        return self._layout().generate_html_window(self, rows, columns,
+                                                   cell_format)
+
+    def write_html(self, fp, encoding=None, stats=None, cell_format=None):
+        """
+        Writes the HTML table to ``fp`` as it is generated.
+
+        :arg fp: A file-like object with a ``write`` method.
+        :arg encoding: If set, chunks are encoded before being written,
+                       for binary files and sockets.
+        :type encoding: unicode or None
+        :arg stats: See :meth:`generate_html_iter`.
+        :arg cell_format: See :meth:`generate_html_iter`.
+        """
+
+        for chunk in self.generate_html_iter(stats, cell_format):
+            fp.write(chunk if encoding is None else chunk.encode(encoding))
 
     def get_ugliness(self):
         """
@@ -344,99 +859,2370 @@ class TableDict(OrderedDict):
         :rtype: int
         """
 
-        vertical_length = self._get_final_length(self.vertical_headers())
-        horizontal_length = self._get_final_length(self.horizontal_headers())
+        vertical_length = self._headers_length(VERTICAL)
+        horizontal_length = self._headers_length(HORIZONTAL)
         ugliness = vertical_length + horizontal_length
         ugliness += abs(vertical_length - horizontal_length)
         return ugliness
 
 
-class HorizontalTableDictMeta(type):
-    def __repr__(cls):
-        return 'h'
-
+class TableDict(BaseTableDict, OrderedDict):
+    """
+    TableDict objects are ordered dicts with methods that renders HTML tables.
 
-class VerticalTableDictMeta(type):
-    def __repr__(cls):
-        return 'v'
+    Here is an ugly schema to define the terms I’m using:
 
+    +---------+-------------+-------------+-------------+-------------+
+    |         |     hh1     |     hh2     |     hh3     |     hh4     |
+    |         +------+------+------+------+------+------+------+------+
+    |         | hh11 | hh12 | hh21 | hh22 | hh31 | hh32 | hh41 | hh42 |
+    +=========+======+======+======+======+======+======+======+======+
+    | **vh1** |  dA  |  dB  |  dC  |  dE  |  dF  |  dG  |  dH  |  dI  |
+    +---------+------+------+------+------+------+------+------+------+
+    | **vh2** |  dJ  |  dK  |  dL  |  dM  |  dN  |  dO  |  dP  |  dQ  |
+    +---------+------+------+------+------+------+------+------+------+
+    | **vh3** |  dR  |  dS  |  dT  |  dU  |  dV  |  dW  |  dX  |  dY  |
+    +---------+------+------+------+------+------+------+------+------+
 
-class HorizontalTableDict(TableDict):
+    `hh1`, `hh11`, `hh2` […] are horizontal headers,
+    `vh1`, `vh2`, […] are vertical headers,
+    and `dA`, `dB`, […] are data.
     """
-    Same as :class:`TableDict`, but with a direction.
 
-    The direction is used to specify whether the headers of the first depth
-    of the current object should be put on the horizontal or vertical axis.
-    """
+    _parents = ()
+    # Changed leaves, see ``track_changes``.
+    _changes = None
+    _shape_changed = False
+    _frozen = False
 
-    __metaclass__ = HorizontalTableDictMeta
-    direction = HORIZONTAL
+    @property
+    def frozen(self):
+        """
+        Whether ``self`` is frozen, see :meth:`freeze`.
 
+        :rtype: bool
+        """
 
-class VerticalTableDict(TableDict):
-    __doc__ = HorizontalTableDict.__doc__
-    __metaclass__ = VerticalTableDictMeta
-    direction = VERTICAL
+        return self._frozen
 
+    def freeze(self):
+        """
+        Makes ``self`` and all its nested :class:`TableDict` s immutable,
+        and computes everything :meth:`generate_html` needs.
 
-h = HorizontalTableDict
-v = VerticalTableDict
+        Rendering a frozen table only reads its caches, so it can be
+        rendered by many threads at the same time, including on
+        free-threaded builds of Python.  Changing it raises
+        :class:`TypeError`.  Deep copies and unpickled tables are not
+        frozen.
 
+        Rendering with a :class:`CellFormat` still caches a layout on first
+        use.  It is safe, at worst computed twice.
 
-def get_all_structures(datadict):
-    """
-    Returns all the possible structures for a datadict.
+        :returns: ``self``.
+        :rtype: TableDict
+        """
 
-    :arg datadict: Nested dicts or association lists.  Association lists have
-                   the advantage of being ordered.
-    :returns: All possible structures.
-    :rtype: list
-    """
+        tables = [self]
+        while tables:
+            table = tables.pop()
+            table._frozen = True
+            tables.extend(value for value in table.values()
+                          if isinstance(value, TableDict))
+        self.horizontal_headers()
+        self.vertical_headers()
+        self._headers_length(HORIZONTAL)
+        self._headers_length(VERTICAL)
+        self._get_data()
+        return self
+
+    def _check_mutable(self):
+        if self._frozen:
+            raise TypeError('A frozen TableDict cannot be changed.')
+
+    def _items_in(self, keys):
+        if len(self) < len(keys):
+            return BaseTableDict._items_in(self, keys)
+        # Keys are already indexed, looking them up is faster.
+        return [(k, self[k]) for k in keys if k in self]
+
+    def _invalidate(self, path=(), value=None, shape_changed=True):
+        """
+        Empties the cache of ``self`` and of all the :class:`TableDict` s
+        containing it.
 
-    return list(product((v, h), repeat=TableDict._get_headers_depth(datadict)))
+        When only the data of an existing leaf changed, headers and layouts
+        are kept, and cached data is updated in place.
 
+        :arg tuple path: Keys leading from ``self`` to the changed leaf.
+        :arg value: New value of the changed leaf.
+        :arg bool shape_changed: Whether headers may have changed.
+        """
 
-def build_table_dict(datadict, structure):
-    """
-    Automatically builds a TableDict from ``datadict`` and ``structure``.
+        if shape_changed:
+            self._cache = None
+        elif self._cache:
+            data_key = ('data', tuple(self.structure))
+            for key in [key for key in self._cache
+                        if isinstance(key, tuple) and key[0] == 'data']:
+                if key == data_key and ('layout', tuple(self.structure)) \
+                        in self._cache:
+                    data = self._cache[key]
+                    width = self._layout().width
+                    for row, column in self._get_cells(path):
+                        data[row * width + column] = value
+                else:
+                    del self._cache[key]
+        if self._changes is not None:
+            if shape_changed:
+                self._shape_changed = True
+            else:
+                self._changes.pop(path, None)
+                self._changes[path] = value
+        for parent_ref, key in self._parents:
+            parent = parent_ref()
+            if parent is not None:
+                parent._invalidate((key,) + path, value, shape_changed)
+
+    def _link(self, key, value):
+        if isinstance(value, TableDict):
+            value._parents = [
+                (ref, k) for ref, k in value._parents
+                if ref() is not None and (ref() is not self or k != key)]
+            value._parents.append((weakref.ref(self), key))
+
+    def _unlink(self, key, value):
+        if isinstance(value, TableDict):
+            value._parents = [
+                (ref, k) for ref, k in value._parents
+                if ref() is not None and (ref() is not self or k != key)]
+
+    def __setitem__(self, key, value):
+        self._check_mutable()
+        old_value = self.get(key)
+        shape_changed = (key not in self or isinstance(old_value, TableDict)
+                         or isinstance(value, TableDict))
+        if old_value is not value:
+            self._unlink(key, old_value)
+        super(TableDict, self).__setitem__(key, value)
+        self._link(key, value)
+        self._invalidate((key,), value, shape_changed)
+
+    def __delitem__(self, key):
+        self._check_mutable()
+        self._unlink(key, self.get(key))
+        super(TableDict, self).__delitem__(key)
+        self._invalidate()
+
+    def pop(self, key, *args):
+        self._check_mutable()
+        had_key = key in self
+        value = super(TableDict, self).pop(key, *args)
+        if had_key:
+            self._unlink(key, value)
+            self._invalidate()
+        return value
+
+    def popitem(self, last=True):
+        self._check_mutable()
+        key, value = super(TableDict, self).popitem(last)
+        self._unlink(key, value)
+        self._invalidate()
+        return key, value
+
+    def move_to_end(self, key, last=True):
+        self._check_mutable()
+        super(TableDict, self).move_to_end(key, last)
+        self._invalidate()
+
+    def clear(self):
+        self._check_mutable()
+        for key, value in self.items():
+            self._unlink(key, value)
+        super(TableDict, self).clear()
+        self._invalidate()
+
+    def __reduce__(self):
+        # Caches and parent links are rebuilt after unpickling or copying.
+        reduced = super(TableDict, self).__reduce__()
+        state = dict((k, v) for k, v in (reduced[2] or {}).items()
+                     if k not in ('_cache', '_parents', '_changes',
+                                  '_shape_changed', '_frozen')) or None
+        return reduced[:2] + (state,) + reduced[3:]
+
+    def track_changes(self):
+        """
+        Starts recording the leaves changed in ``self`` or in its nested
+        :class:`TableDict` s, so that only the modified cells can be sent
+        to a live report.
 
-    :arg datadict: Nested dicts or association lists.  Association lists have
-                   the advantage of being ordered.
-    :type datadict: dict or tuple or list
-    :arg structure: Structure of the headers of the returned object.  This
-                    must be a sequence of ``h`` and/or ``v``,
-                    one per depth level of ``datadict``.
-    :type structure: list or tuple
-    :returns: Nested :class:`TableDict` s with horizontal and/or vertical
-              structures applied, according to ``structure``.
-    :rtype: HorizontalTableDict or VerticalTableDict
-    """
+        See :meth:`get_patches` and :meth:`get_row_patches`.
+        """
 
-    def apply_structure(datadict, structure, level=0):
-        datadict = structure[level](datadict)
-        for k, v in datadict.items():
-            if isinstance(v, tuple):
-                datadict[k] = apply_structure(v, structure, level + 1)
-        return datadict
+        self._changes = OrderedDict()
+        self._shape_changed = False
 
-    new = apply_structure(datadict, structure)
-    new.structure = structure
-    return new
+    def _pop_changed_cells(self):
+        if self._changes is None:
+            raise ValueError('Call track_changes() first.')
+        changes, shape_changed = self._changes, self._shape_changed
+        self.track_changes()
+        if shape_changed:
+            return None
+        return [(row, column, value) for path, value in changes.items()
+                for row, column in self._get_cells(path)]
 
+    def get_patches(self, cell_format=None):
+        """
+        Returns the cells changed since :meth:`track_changes` or the previous
+        call to a ``get_*patches`` method.
+
+        Only changes of existing leaves into other leaves can be patched.
+        If keys were added, removed or changed into nested tables,
+        headers may have changed, so the whole table must be rendered again.
+
+        :arg cell_format: See :meth:`generate_html_iter`.
+        :type cell_format: CellFormat or None
+        :returns: ``(row, column, html)`` tuples, where ``html`` is the new
+                  ``<td>`` of the cell, or ``None`` if the table must be
+                  rendered again.
+        :rtype: list or None
+        """
 
-def build_optimal_table_dict(datadict):
-    """
-    Automatically builds the less ugly table possible from ``datadict``.
+        cells = self._pop_changed_cells()
+        if cells is None:
+            return None
+        formatters = self._layout()._get_formatters(cell_format)
+        return [(row, column, _render_cells(
+                    (value,), formatters and formatters[column:column + 1]))
+                for row, column, value in cells]
 
-    :arg datadict: Nested dicts or association lists.  Association lists have
-                   the advantage of being ordered.
-    :type datadict: dict or tuple or list
-    :returns: Nested :class:`TableDict` with horizontal and/or vertical
-                  structures applied, according to ``structure``.
+    def get_row_patches(self, cell_format=None):
+        """
+        Same as :meth:`get_patches`, but returns ``(row, html)`` tuples,
+        where ``html`` is the whole new ``<tr>`` of each changed row.
+        """
+
+        cells = self._pop_changed_cells()
+        if cells is None:
+            return None
+        layout = self._layout(cell_format)
+        formatters = layout._get_formatters(cell_format)
+        data = self._get_data()
+        return [(row, '<tr>%s</tr>' % layout._render_row(
+                    row, data, formatters)[len('</tr><tr>'):])
+                for row in sorted(set(row for row, _, _ in cells))]
+
+
+def _render_cells(data, formatters=None):
+    """
+    Returns the ``<td>`` of ``data``.
+
+    All render paths write data cells with this function.  ``formatters``
+    are the formatters of the columns of ``data``, as returned by
+    :func:`_get_cell_formatters`.  By default, data is inserted as is.
+    """
+
+    if formatters is None:
+        return ''.join(['<td>%s</td>' % ('-' if d is None else d)
+                        for d in data])
+    return ''.join(['<td>%s</td>' % format_cell(d)
+                    for format_cell, d in zip(formatters, data)])
+
+
+def _get_cell_formatters(cell_format, accessors):
+    """
+    Returns the formatters of the columns at ``accessors``, or ``None``
+    if ``cell_format`` is ``None``.
+    """
+
+    if cell_format is None:
+        return None
+    return [cell_format._get_cell_formatter(accessor)
+            for accessor in accessors or ((),)]
+
+
+def _render_band(row_prefixes, data, width, accessors=None,
+                 cell_format=None):
+    """
+    Renders rows like :meth:`TableLayout._render_row`.  This is a function,
+    so that it can run in other processes.  Formatters are resolved here,
+    since they cannot be pickled.
+    """
+
+    formatters = _get_cell_formatters(cell_format, accessors)
+    return ''.join(
+        prefix + _render_cells(data[width * i:width * (i + 1)], formatters)
+        for i, prefix in enumerate(row_prefixes))
+
+
+# Default executor of ``generate_html_parallel``, shared by all calls so that
+# its workers are started once.
+_parallel_executor = None
+_parallel_executor_lock = threading.Lock()
+
+
+def _get_parallel_executor():
+    """
+    Returns the default executor of :meth:`TableDict.generate_html_parallel`:
+    threads on free-threaded builds of Python, processes elsewhere, since
+    the GIL serializes threads.
+    """
+
+    global _parallel_executor
+    with _parallel_executor_lock:
+        if _parallel_executor is None:
+            if getattr(sys, '_is_gil_enabled', lambda: True)():
+                _parallel_executor = ProcessPoolExecutor()
+            else:
+                _parallel_executor = ThreadPoolExecutor()
+        return _parallel_executor
+
+
+def _escape_html(text):
+    return (text.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+
+
+def _format_header(header):
+    return _escape_html('%s' % (header,))
+
+
+def _get_header_formatter(cell_format):
+    """
+    Returns the function converting headers to HTML for ``cell_format``,
+    or ``None`` if headers are inserted as is.
+    """
+
+    if cell_format is None or cell_format._get_header_key() is None:
+        return None
+    return cell_format.format_header
+
+
+# ``type(2 ** 64)`` is ``long`` on Python 2.
+_NUMBER_TYPES = frozenset([int, float, type(2 ** 64)])
+
+
+class CellFormat(object):
+    """
+    How headers and data are converted to HTML by
+    :meth:`TableDict.generate_html`.
+
+    Formatters are resolved once per column.  Numbers without a formatter
+    skip escaping.
+
+    >>> table = build_table_dict((('a&b', (('x', 0.5), ('y', '<i>'))),),
+    ...                          (v, h))
+    >>> cell_format = CellFormat(types={float: '{:.0%}'.format},
+    ...                          missing='')
+    >>> html = table.generate_html(cell_format=cell_format)
+    >>> '<th colspan="1">a&amp;b</th><td>50%</td><td>&lt;i&gt;</td>' in html
+    True
+
+    :arg escape: Whether headers and data are HTML-escaped.
+    :type escape: bool
+    :arg missing: HTML of empty cells.
+    :type missing: unicode
+    :arg types: Formatters of data, by exact type.  A formatter is a
+                function returning the text of a value.
+    :type types: dict or None
+    :arg columns: Formatters of data, by path of horizontal headers.
+                  The longest path leading to a column is used.  They have
+                  priority over ``types``.
+    :type columns: dict or None
+    """
+
+    def __init__(self, escape=True, missing='-', types=None, columns=None):
+        self.escape = escape
+        self.missing = missing
+        self.types = dict(types or {})
+        self.columns = dict(columns or {})
+
+    def format_header(self, header):
+        """
+        Returns the HTML of ``header``.
+
+        Subclasses can override it.  Header rows are then cached for the
+        last class and attributes of :class:`CellFormat` used with each
+        structure.
+
+        :rtype: unicode
+        """
+
+        return _format_header(header) if self.escape else header
+
+    def _get_header_key(self):
+        """
+        Returns what the HTML of headers depends on, to cache layouts,
+        or ``None`` if headers are inserted as is.
+        """
+
+        if type(self).format_header != CellFormat.format_header:
+            # It may depend on anything in ``self``.
+            return type(self), dict(vars(self))
+        return 'escaped' if self.escape else None
+
+    def _get_cell_formatter(self, accessor):
+        """
+        Returns a function converting data of the column at ``accessor``
+        to HTML.
+        """
+
+        column_formatter = None
+        for length in range(len(accessor), -1, -1):
+            column_formatter = self.columns.get(accessor[:length])
+            if column_formatter is not None:
+                break
+        missing = self.missing
+        escape = _escape_html if self.escape else None
+        types = self.types
+        if column_formatter is None:
+            def format_cell(d):
+                if d is None:
+                    return missing
+                formatter = types.get(type(d))
+                if formatter is None:
+                    if type(d) in _NUMBER_TYPES:
+                        return '%s' % d
+                    text = '%s' % d
+                else:
+                    text = formatter(d)
+                return text if escape is None else escape(text)
+        else:
+            def format_cell(d):
+                if d is None:
+                    return missing
+                text = column_formatter(d)
+                return text if escape is None else escape(text)
+        return format_cell
+
+
+class TableLayout(object):
+    """
+    Immutable HTML layout of a :class:`TableDict`, independent from its data.
+
+    It holds the HTML of header rows, including all colspans and rowspans,
+    and the order of data cells.  It can render any :class:`TableDict` that
+    has the same headers and structure, so that rendering it again only costs
+    extracting and formatting data.
+
+    Use :func:`compile_layout` to get one.
+
+    :ivar tuple structure: Structure of the rendered tables.
+    :ivar tuple horizontal_accessors: Accessors of each column.
+    :ivar tuple vertical_accessors: Accessors of each row.
+    :ivar tuple header_rows: HTML of horizontal header rows.
+    :ivar tuple row_prefixes: HTML of each data row before its cells,
+                              i.e. vertical headers.
+    :ivar unicode footer: HTML after the last cell.
+    :ivar int width: Number of data cells per row.
+    """
+
+    __slots__ = ('structure', 'horizontal_accessors', 'vertical_accessors',
+                 'header_rows', 'row_prefixes', 'footer', 'width',
+                 '_depths', '_horizontal_spans', '_horizontal_ends',
+                 '_vertical_spans', '_row_starts')
+
+    def __init__(self, structure, horizontal_headers, vertical_headers,
+                 format_header=None):
+        lengths = {}
+        width = TableDict._get_group_lengths(horizontal_headers, lengths)
+        TableDict._get_group_lengths(vertical_headers, lengths)
+
+        # Positions of headers, used to render windows of the table.
+        horizontal_spans = []
+        for start, end, depth, header, is_leaf, parent \
+                in self._get_spans(horizontal_headers, lengths):
+            if depth == len(horizontal_spans):
+                horizontal_spans.append([])
+            horizontal_spans[depth].append((start, end, header, is_leaf))
+        vertical_spans = self._get_spans(vertical_headers, lengths)
+        row_starts = [i for i, span in enumerate(vertical_spans)
+                      if i == 0 or span[0] != vertical_spans[i - 1][0]]
+
+        header_rows = []
+        out = ['<table>']
+        if horizontal_headers:
+            horizontal_depth = TableDict._get_headers_depth(
+                horizontal_headers)
+            out.append('<tr>')
+            if vertical_headers:
+                # Creates the top left empty cell.
+                out.append('<td colspan="%s" rowspan="%s" '
+                           'style="border: none;"></td>'
+                           % (TableDict._get_headers_depth(vertical_headers),
+                              horizontal_depth))
+            # Creates horizontal headers.
+            previous_depth = 0
+            for header, depth, props, is_leaf \
+                    in TableDict._horizontal_header_iterator(
+                        horizontal_headers, horizontal_depth, lengths):
+                if depth != previous_depth:
+                    header_rows.append(''.join(out))
+                    out = ['</tr><tr>']
+                    previous_depth = depth
+                out.append(build_tag(
+                    'th', props,
+                    header if format_header is None
+                    else format_header(header)))
+        header_rows.append(''.join(out))
+
+        # Creates vertical headers, one string per line of data.
+        if vertical_headers:
+            rows = []
+            previous_depth = 0
+            for header, depth, props, is_leaf \
+                    in TableDict._vertical_header_iterator(
+                        vertical_headers,
+                        TableDict._get_headers_depth(vertical_headers),
+                        lengths):
+                if depth <= previous_depth:
+                    rows.append(['</tr><tr>'])
+                rows[-1].append(build_tag(
+                    'th', props,
+                    header if format_header is None
+                    else format_header(header)))
+                previous_depth = depth
+            row_prefixes = [''.join(row) for row in rows]
+            footer = '</table>'
+        else:
+            row_prefixes = ['</tr><tr>']
+            footer = '</tr></table>'
+
+        for name, value in (
+                ('structure', tuple(structure)),
+                ('horizontal_accessors', tuple(
+                    TableDict._accessors_iterator(horizontal_headers))),
+                ('vertical_accessors', tuple(
+                    TableDict._accessors_iterator(vertical_headers))),
+                ('header_rows', tuple(header_rows)),
+                ('row_prefixes', tuple(row_prefixes)),
+                ('footer', footer),
+                ('width', width or 1),
+                ('_depths', (TableDict._get_headers_depth(vertical_headers),
+                             TableDict._get_headers_depth(
+                                 horizontal_headers))),
+                ('_horizontal_spans', tuple(tuple(spans)
+                                            for spans in horizontal_spans)),
+                ('_horizontal_ends', tuple(
+                    tuple(span[1] for span in spans)
+                    for spans in horizontal_spans)),
+                ('_vertical_spans', tuple(vertical_spans)),
+                ('_row_starts', tuple(row_starts) + (len(vertical_spans),))):
+            object.__setattr__(self, name, value)
+
+    @staticmethod
+    def _get_spans(headers, lengths):
+        """
+        Returns the position of each header, in the order of
+        :meth:`TableDict._vertical_header_iterator`.
+
+        Positions are prefix sums of the final lengths of groups.
+
+        :returns: ``(start, end, depth, header, is_leaf, parent)`` tuples,
+                  where ``start`` and ``end`` are the first and after last
+                  rows or columns covered by the header, and ``parent``
+                  is the index of the parent header, or ``None``.
+        :rtype: list
+        """
+
+        spans = []
+
+        def walk(headers, depth, start, parent):
+            for item in headers:
+                if isinstance(item, list):
+                    header, group = item
+                    end = start + lengths[id(group)]
+                    spans.append((start, end, depth, header, False, parent))
+                    walk(group, depth + 1, start, len(spans) - 1)
+                    start = end
+                else:
+                    spans.append((start, start + 1, depth, item, True,
+                                  parent))
+                    start += 1
+
+        walk(headers, 0, 0, None)
+        return spans
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s objects are immutable.'
+                             % self.__class__.__name__)
+
+    __delattr__ = __setattr__
+
+    def _fill_cells(self, table_dict, set_cell, rows=None, columns=None):
+        """
+        Calls ``set_cell(row, column, data)`` for each cell of ``table_dict``
+        that contains data.
+
+        ``rows`` and ``columns`` restrict the cells to these
+        ``(index, accessor)`` pairs.  By default, all cells are filled.
+
+        Instead of looking up each cell from the root of ``table_dict``,
+        accessors are partitioned level by level while walking down the tree,
+        so each node is visited once, and only cells containing data
+        are yielded.
+
+        A cell is filled when walking down its accessors leads to something
+        else than a :class:`TableDict`, either at the end of ``structure``
+        or when the accessor needed by the current level is exhausted.
+        """
+
+        structure = self.structure
+        depth = len(structure)
+        if rows is None:
+            rows = self._get_indexed_accessors(VERTICAL)
+        if columns is None:
+            columns = self._get_indexed_accessors(HORIZONTAL)
+        partitions = {}
+
+        def partition(accessors, position):
+            # Identical lists are partitioned many times at the same
+            # position, e.g. all columns below each vertical header.
+            key = (id(accessors), position)
+            try:
+                return partitions[key][1:]
+            except KeyError:
+                pass
+            exhausted = []
+            groups = OrderedDict()
+            for item in accessors:
+                accessor = item[1]
+                if len(accessor) == position:
+                    exhausted.append(item)
+                else:
+                    groups.setdefault(accessor[position], []).append(item)
+            # ``accessors`` is kept alive so that its id is not reused.
+            partitions[key] = (accessors, exhausted, groups)
+            return exhausted, groups
+
+        def walk(node, level, rows, columns, y, x):
+            is_table = isinstance(node, BaseTableDict)
+            if level == depth:
+                if not is_table:
+                    for row, _ in rows:
+                        for column, _ in columns:
+                            set_cell(row, column, node)
+                return
+
+            is_horizontal = structure[level].direction == HORIZONTAL
+            exhausted, groups = partition(
+                columns if is_horizontal else rows, x if is_horizontal else y)
+            if exhausted and not is_table:
+                for row, _ in (rows if is_horizontal else exhausted):
+                    for column, _ in (exhausted if is_horizontal
+                                      else columns):
+                        set_cell(row, column, node)
+
+            if is_table:
+                children = ((k, child, groups[k])
+                            for k, child in node._items_in(groups))
+            else:
+                def children():
+                    for k, group in groups.items():
+                        try:
+                            yield k, node[k], group
+                        except (TypeError, KeyError):
+                            pass
+                children = children()
+            for k, child, group in children:
+                if is_horizontal:
+                    walk(child, level + 1, rows, group, y, x + 1)
+                else:
+                    walk(child, level + 1, group, columns, y + 1, x)
+
+        walk(table_dict, 0, rows, columns, 0, 0)
+
+    def _check_structure(self, table_dict):
+        if tuple(table_dict.structure) != self.structure:
+            raise ValueError('The structure of the table does not match '
+                             'the structure of the layout.')
+
+    def _get_indexed_accessors(self, side, start=0, stop=None):
+        # Tables without headers on one side still have one row or column.
+        accessors = getattr(self, side + '_accessors') or ((),)
+        return tuple(enumerate(accessors[start:stop], start))
+
+    def get_data(self, table_dict):
+        """
+        Extracts the data of ``table_dict`` in the cell order of this layout.
+
+        :returns: Row-major data, ``None`` for empty cells.
+        :rtype: list
+        """
+
+        width = self.width
+        data = [None] * (width * len(self.row_prefixes))
+
+        def set_cell(row, column, d):
+            data[row * width + column] = d
+
+        self._fill_cells(table_dict, set_cell)
+        return data
+
+    def _get_formatters(self, cell_format):
+        return _get_cell_formatters(cell_format, self.horizontal_accessors)
+
+    def _render_row(self, i, data, formatters=None, first_row=0):
+        width = self.width
+        start = width * (i - first_row)
+        return self.row_prefixes[i] + _render_cells(
+            data[start:start + width], formatters)
+
+    def _iter_html(self, data, cell_format=None):
+        return self._iter_html_bands(
+            ((0, len(self.row_prefixes), data),), cell_format)
+
+    def _iter_html_bands(self, bands, cell_format=None):
+        """
+        Same as :meth:`_iter_html`, with data split in ``bands``
+        of ``(first_row, last_row, data)``.
+        """
+
+        formatters = self._get_formatters(cell_format)
+        render_row = self._render_row
+        for chunk in self.header_rows:
+            yield chunk
+        last_index = len(self.row_prefixes) - 1
+        for first_row, last_row, data in bands:
+            for i in range(first_row, last_row):
+                chunk = render_row(i, data, formatters, first_row)
+                yield chunk + self.footer if i == last_index else chunk
+
+    def _get_data_band(self, table_dict, first_row, last_row):
+        """
+        Returns the data cells of ``table_dict`` from row ``first_row``
+        to row ``last_row`` excluded.
+        """
+
+        width = self.width
+        data = [None] * (width * (last_row - first_row))
+
+        def set_cell(row, column, d):
+            data[(row - first_row) * width + column] = d
+
+        self._fill_cells(
+            table_dict, set_cell,
+            self._get_indexed_accessors(VERTICAL, first_row, last_row))
+        return data
+
+    def _get_bands(self, count):
+        """
+        Splits rows in about ``count`` bands of whole top-level vertical
+        header groups.
+
+        :returns: ``(first_row, last_row)`` of each band.
+        :rtype: list
+        """
+
+        row_count = len(self.row_prefixes)
+        band_size = max(1, row_count // count)
+        bands = []
+        first_row = 0
+        for start, end, depth, header, is_leaf, parent \
+                in self._vertical_spans:
+            if depth == 0 and end - first_row >= band_size:
+                bands.append((first_row, end))
+                first_row = end
+        if first_row < row_count:
+            bands.append((first_row, row_count))
+        return bands
+
+    def _render_parallel(self, table_dict, executor, count,
+                         cell_format=None):
+        width = self.width
+        accessors = (None if cell_format is None
+                     else self.horizontal_accessors)
+        out = list(self.header_rows)
+        # At most ``count`` bands of data are waiting to be rendered.
+        futures = deque()
+        for first, last in table_dict._get_parallel_bands(self, count):
+            if len(futures) >= count:
+                out.append(futures.popleft().result())
+            futures.append(executor.submit(
+                _render_band, self.row_prefixes[first:last],
+                table_dict._get_data_band(self, first, last), width,
+                accessors, cell_format))
+        out.extend(future.result() for future in futures)
+        out.append(self.footer)
+        return ''.join(out)
+
+    def _iter_html_cells(self, band, cells, formatters=None):
+        """
+        Yields the HTML of the rows of ``band``, a
+        ``(first_row, last_row, data)`` tuple, a chunk every ``cells``
+        data cells instead of every row.
+
+        Header rows and the footer are not included.
+        """
+
+        first_row, last_row, data = band
+        width = self.width
+        out = []
+        count = 0
+        for i in range(first_row, last_row):
+            out.append(self.row_prefixes[i])
+            start = width * (i - first_row)
+            row = data[start:start + width]
+            column = 0
+            while column < width:
+                end = min(width, column + cells - count)
+                out.append(_render_cells(
+                    row[column:end], formatters and formatters[column:end]))
+                count += end - column
+                column = end
+                if count == cells:
+                    yield ''.join(out)
+                    out = []
+                    count = 0
+        if out:
+            yield ''.join(out)
+
+    def generate_html_window(self, table_dict, rows=None, columns=None,
+                             cell_format=None):
+        """
+        Same as :meth:`TableDict.generate_html_window`, using this layout
+        to render ``table_dict``.
+        """
+
+        self._check_structure(table_dict)
+        format_header = _get_header_formatter(cell_format)
+        formatters = self._get_formatters(cell_format)
+        first_row, last_row = _get_slice_bounds(rows, len(self.row_prefixes))
+        first_column, last_column = _get_slice_bounds(columns, self.width)
+        width = last_column - first_column
+
+        data = [None] * (width * (last_row - first_row))
+
+        def set_cell(row, column, d):
+            data[(row - first_row) * width + column - first_column] = d
+
+        self._fill_cells(
+            table_dict, set_cell,
+            self._get_indexed_accessors(VERTICAL, first_row, last_row),
+            self._get_indexed_accessors(HORIZONTAL, first_column,
+                                        last_column))
+
+        vertical_depth, horizontal_depth = self._depths
+        out = ['<table>']
+        if self._horizontal_spans:
+            out.append('<tr>')
+            if self._vertical_spans:
+                # Creates the top left empty cell.
+                out.append('<td colspan="%s" rowspan="%s" '
+                           'style="border: none;"></td>'
+                           % (vertical_depth, horizontal_depth))
+            header_rows = []
+            for depth, spans in enumerate(self._horizontal_spans):
+                i = bisect_right(self._horizontal_ends[depth], first_column)
+                header_row = []
+                for start, end, header, is_leaf in spans[i:]:
+                    if start >= last_column:
+                        break
+                    if is_leaf:
+                        props = {'rowspan': horizontal_depth - depth}
+                    else:
+                        props = {'colspan': min(end, last_column)
+                                 - max(start, first_column)}
+                    header_row.append(build_tag(
+                        'th', props, header if format_header is None
+                        else format_header(header)))
+                header_rows.append(''.join(header_row))
+            out.append('</tr><tr>'.join(header_rows))
+
+        spans = self._vertical_spans
+        for row in range(first_row, last_row):
+            out.append('</tr><tr>')
+            if spans:
+                indexes = list(range(self._row_starts[row],
+                                     self._row_starts[row + 1]))
+                if row == first_row:
+                    # Headers started above the window are cut.
+                    parent = spans[indexes[0]][5]
+                    while parent is not None:
+                        indexes.insert(0, parent)
+                        parent = spans[parent][5]
+                for i in indexes:
+                    start, end, depth, header, is_leaf, parent = spans[i]
+                    if is_leaf:
+                        props = {'colspan': vertical_depth - depth}
+                    else:
+                        props = {'rowspan': min(end, last_row)
+                                 - max(start, first_row)}
+                    out.append(build_tag(
+                        'th', props, header if format_header is None
+                        else format_header(header)))
+            i = (row - first_row) * width
+            out.append(_render_cells(
+                data[i:i + width],
+                formatters and formatters[first_column:last_column]))
+        out.append(self.footer)
+        return ''.join(out)
+
+    def generate_html_iter(self, table_dict):
+        """
+        Same as :meth:`TableDict.generate_html_iter`, using this layout
+        to render ``table_dict``.
+        """
+
+        self._check_structure(table_dict)
+        return self._iter_html(self.get_data(table_dict))
+
+    def generate_html(self, table_dict):
+        """
+        Same as :meth:`TableDict.generate_html`, using this layout
+        to render ``table_dict``.
+        """
+
+        return ''.join(self.generate_html_iter(table_dict))
+
+    def _get_grid_headers(self):
+        """
+        Returns the items of :meth:`TableDict.get_grid` except ``data``.
+        """
+
+        vertical_depth, horizontal_depth = self._depths
+        horizontal_headers = [
+            [[_to_json(header), 1, horizontal_depth - depth] if is_leaf
+             else [_to_json(header), end - start, 1]
+             for start, end, header, is_leaf in spans]
+            for depth, spans in enumerate(self._horizontal_spans)]
+        vertical_headers = [[] for _ in self.row_prefixes]
+        for start, end, depth, header, is_leaf, _ in self._vertical_spans:
+            vertical_headers[start].append(
+                [_to_json(header), vertical_depth - depth, 1] if is_leaf
+                else [_to_json(header), 1, end - start])
+        corner = None
+        if self._horizontal_spans and self._vertical_spans:
+            corner = [vertical_depth, horizontal_depth]
+        return {
+            'width': self.width,
+            'height': len(self.row_prefixes),
+            'corner': corner,
+            'horizontal_headers': horizontal_headers,
+            'vertical_headers': vertical_headers,
+        }
+
+    def _get_grid(self, bands):
+        """
+        Returns the grid of the data ``bands``, ``(first_row, last_row,
+        data)`` tuples.
+        """
+
+        grid = self._get_grid_headers()
+        data = grid['data'] = []
+        for first_row, last_row, band in bands:
+            data.extend([_to_json(d) for d in band])
+        return grid
+
+    def _iter_json(self, bands):
+        """
+        Yields the JSON of :meth:`_get_grid`, a chunk per band of data.
+        """
+
+        dumps = partial(json.dumps, ensure_ascii=False,
+                        separators=(',', ':'), allow_nan=False)
+        yield dumps(self._get_grid_headers())[:-1] + ',"data":['
+        separator = ''
+        for first_row, last_row, band in bands:
+            if band:
+                yield separator + dumps([_to_json(d) for d in band])[1:-1]
+                separator = ','
+        yield ']}'
+
+    def get_grid(self, table_dict):
+        """
+        Same as :meth:`TableDict.get_grid`, using this layout
+        to export ``table_dict``.
+        """
+
+        self._check_structure(table_dict)
+        return self._get_grid(
+            ((0, len(self.row_prefixes), self.get_data(table_dict)),))
+
+
+_JSON_TYPES = (type(None), bool, int, float, type(''))
+
+
+def _to_json(value):
+    if isinstance(value, float):
+        # JSON has neither NaN nor infinity.
+        return (None if math.isnan(value) or math.isinf(value)
+                else value)
+    return value if isinstance(value, _JSON_TYPES) else '%s' % (value,)
+
+
+def _get_slice_bounds(s, length):
+    if s is None:
+        return 0, length
+    start, stop, step = s.indices(length)
+    if step != 1:
+        raise ValueError('Windows can only be contiguous.')
+    return start, max(start, stop)
+
+
+def compile_layout(table_dict):
+    """
+    Returns the layout of ``table_dict``, reusable for tables of the same
+    shape.
+
+    :arg TableDict table_dict: A table built by :func:`build_table_dict`.
+    :rtype: TableLayout
+    """
+
+    return table_dict._layout()
+
+
+class HorizontalTableDictMeta(type):
+    def __repr__(cls):
+        return 'h'
+
+
+class VerticalTableDictMeta(type):
+    def __repr__(cls):
+        return 'v'
+
+
+class HorizontalTableDict(TableDict):
+    """
+    Same as :class:`TableDict`, but with a direction.
+
+    The direction is used to specify whether the headers of the first depth
+    of the current object should be put on the horizontal or vertical axis.
+    """
+
+    __metaclass__ = HorizontalTableDictMeta
+    direction = HORIZONTAL
+
+
+class VerticalTableDict(TableDict):
+    __doc__ = HorizontalTableDict.__doc__
+    __metaclass__ = VerticalTableDictMeta
+    direction = VERTICAL
+
+
+h = HorizontalTableDict
+v = VerticalTableDict
+
+
+class TableDictView(BaseTableDict, Mapping):
+    """
+    Read-only :class:`BaseTableDict` over a datadict, without copying it.
+
+    Nested association lists are wrapped in other views each time they are
+    accessed, and the direction of each level is taken from ``structure``.
+    Nested views are not kept, so after rendering only the root view holds
+    headers and data.
+    Keys are indexed only for levels where ``__getitem__`` is used.  Like
+    with :func:`build_table_dict`, only tuples are nested tables, and
+    duplicate keys keep the position of their first occurrence and the value
+    of their last one.
+
+    The datadict must not be modified while the view is used.
+
+    :arg datadict: Nested dicts or association lists.
+    :type datadict: dict or tuple or list
+    :arg structure: Sequence of ``h`` and/or ``v``, one per depth level
+                    of ``datadict``.
+    :type structure: list or tuple
+    """
+
+    __slots__ = ('_datadict', 'structure', 'direction', '_index',
+                 '_has_duplicates', '_cache')
+
+    def __init__(self, datadict, structure):
+        self._datadict = datadict
+        self.structure = tuple(structure)
+        self.direction = self.structure[0].direction
+        self._index = None
+        self._has_duplicates = None
+        self._cache = None
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = OrderedDict(self._datadict)
+        return self._index
+
+    def _get_pairs(self):
+        if self._index is not None:
+            return self._index.items()
+        if isinstance(self._datadict, Mapping):
+            return self._datadict.items()
+        if self._has_duplicates is None:
+            keys = set()
+            self._has_duplicates = False
+            for k, _ in self._datadict:
+                if k in keys:
+                    self._has_duplicates = True
+                    break
+                keys.add(k)
+        if self._has_duplicates:
+            return self._get_index().items()
+        return self._datadict
+
+    def _wrap(self, value):
+        if not isinstance(value, tuple):
+            return value
+        return self.__class__(value, self.structure[1:])
+
+    def _nested_headers(self, side):
+        # Headers are only cached by the root view, nested views are not
+        # kept anyway.
+        return self._get_headers(side)
+
+    def items(self):
+        return ((k, self._wrap(value)) for k, value in self._get_pairs())
+
+    def __getitem__(self, key):
+        return self._wrap(self._get_index()[key])
+
+    def __iter__(self):
+        return (k for k, _ in self._get_pairs())
+
+    def __len__(self):
+        return len(self._get_pairs())
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self._datadict,
+                               self.structure)
+
+
+def get_all_structures(datadict):
+    """
+    Returns all the possible structures for a datadict.
+
+    :arg datadict: Nested dicts or association lists.  Association lists have
+                   the advantage of being ordered.
+    :returns: All possible structures.
+    :rtype: list
+    """
+
+    return list(product((v, h), repeat=TableDict._get_headers_depth(datadict)))
+
+
+def build_table_dict(datadict, structure, stats=None):
+    """
+    Automatically builds a TableDict from ``datadict`` and ``structure``.
+
+    :arg datadict: Nested dicts or association lists.  Association lists have
+                   the advantage of being ordered.
+    :type datadict: dict or tuple or list
+    :arg structure: Structure of the headers of the returned object.  This
+                    must be a sequence of ``h`` and/or ``v``,
+                    one per depth level of ``datadict``.
+    :type structure: list or tuple
+    :arg stats: Records the time spent building.
+    :type stats: Stats or None
+    :returns: Nested :class:`TableDict` s with horizontal and/or vertical
+              structures applied, according to ``structure``.
+    :rtype: HorizontalTableDict or VerticalTableDict
+    """
+
+    set_item = OrderedDict.__setitem__
+    # Tuples become nested tables, linked like existing ones.
+    linked_types = (tuple, TableDict)
+
+    def apply_structure(datadict, structure, level=0):
+        new = structure[level]()
+        parent_ref = None
+        if isinstance(datadict, Mapping):
+            datadict = datadict.items()
+        for k, v in datadict:
+            if isinstance(v, linked_types):
+                if isinstance(v, tuple):
+                    v = apply_structure(v, structure, level + 1)
+                    if parent_ref is None:
+                        parent_ref = weakref.ref(new)
+                    v._parents = [(parent_ref, k)]
+                else:
+                    new._link(k, v)
+            # Nothing is cached yet, there is nothing to invalidate.
+            set_item(new, k, v)
+        return new
+
+    if stats is not None:
+        with stats.timer('build'):
+            return build_table_dict(datadict, structure)
+
+    new = apply_structure(datadict, structure)
+    new.structure = structure
+    return new
+
+
+def build_table_dict_from_records(records, structure):
+    """
+    Builds a TableDict from flat records, in a single pass.
+
+    Keys keep the order in which they are first seen.  Like with association
+    lists, a path given twice keeps the last value, and paths can have
+    different lengths.
+
+    >>> table = build_table_dict_from_records(
+    ...     [(('1903', 'maison'), 70), (('1902', 'maison'), 80),
+    ...      (('1903', 'quartier'), 5)], (v, h))
+    >>> table == build_table_dict(
+    ...     (('1903', (('maison', 70), ('quartier', 5))),
+    ...      ('1902', (('maison', 80),))), (v, h))
+    True
+
+    :arg records: An iterable of ``(path, value)``, where ``path`` is
+                  a tuple of keys.  Rows of a database cursor can be turned
+                  into records with ``(row[:-1], row[-1])``.
+    :arg structure: Structure of the headers of the returned object, with
+                    one ``h`` or ``v`` per key of the longest path.
+    :type structure: list or tuple
+    :returns: Nested :class:`TableDict` s with horizontal and/or vertical
+              structures applied, according to ``structure``.
     :rtype: HorizontalTableDict or VerticalTableDict
     """
 
+    new = structure[0]()
+    for path, value in records:
+        node = new
+        for level, key in enumerate(path[:-1], 1):
+            child = node.get(key)
+            if not isinstance(child, TableDict):
+                child = node[key] = structure[level]()
+            node = child
+        key = path[-1]
+        if isinstance(node.get(key), TableDict):
+            node[key] = value
+        else:
+            # Nothing is cached or linked yet, there is nothing to
+            # invalidate.
+            OrderedDict.__setitem__(node, key, value)
+    new.structure = structure
+    return new
+
+
+class CompactTableDict(BaseTableDict, Mapping):
+    """
+    Read-only :class:`BaseTableDict` using much less memory than
+    :class:`TableDict` for large tables.
+
+    Each node only stores a tuple of keys, a parallel tuple of values,
+    and its structure, which is shared with all nodes of the same level.
+
+    Use :func:`build_compact_table_dict` to build one.
+    """
+
+    __slots__ = ('_keys', '_values', 'structure', '_cache')
+
+    def __init__(self, keys, values, structure):
+        self._keys = keys
+        self._values = values
+        self.structure = structure
+        self._cache = None
+
+    @property
+    def direction(self):
+        return self.structure[0].direction
+
+    def _get_index(self):
+        return dict(zip(self._keys, range(len(self._keys))))
+
+    def _nested_headers(self, side):
+        # Headers are only cached by the root table, nested tables
+        # would otherwise each keep a copy of their part of them.
+        return self._get_headers(side)
+
+    def items(self):
+        return zip(self._keys, self._values)
+
+    def __getitem__(self, key):
+        return self._values[self._cached('index', self._get_index)[key]]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__,
+                               tuple(self.items()), self.structure)
+
+
+def build_compact_table_dict(datadict, structure, labels=None):
+    """
+    Same as :func:`build_table_dict`, but returns a
+    :class:`CompactTableDict`.
+
+    Equal text keys are interned, so that repeated header labels are stored
+    once.  Other keys are kept as is: they may be equal but render
+    differently, like ``0.0`` and ``-0.0`` or ``True`` and ``1``.
+
+    :arg labels: Dict of interned labels, indexed by themselves,
+                 to share them between tables.
+    :type labels: dict or None
+    :rtype: CompactTableDict
+    """
+
+    structures = [tuple(structure[level:])
+                  for level in range(len(structure))]
+    if labels is None:
+        labels = {}
+    text_type = type('')
+
+    def intern(k):
+        if type(k) is text_type:
+            return labels.setdefault(k, k)
+        return k
+
+    def build(datadict, level):
+        items = OrderedDict(datadict)
+        return CompactTableDict(
+            tuple(intern(k) for k in items),
+            tuple(build(v, level + 1) if isinstance(v, tuple) else v
+                  for v in items.values()),
+            structures[level])
+
+    return build(datadict, 0)
+
+
+class _DiskLeaves(object):
+    """
+    Leaf values of :class:`DiskTableDict` s, stored in a SQLite database.
+
+    Values are read by pages of consecutive ids, and only the most recently
+    used pages are kept in memory.  Reads are serialized, so that tables can
+    be rendered from other threads.
+    """
+
+    def __init__(self, connection, page_size=1024, max_pages=64):
+        self.connection = connection
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getitem__(self, leaf_id):
+        with self.lock:
+            return self._read(leaf_id)
+
+    def _read(self, leaf_id):
+        page_number = leaf_id // self.page_size
+        page = self.pages.pop(page_number, None)
+        if page is None:
+            start = page_number * self.page_size
+            page = dict(
+                (i, pickle.loads(bytes(value)) if pickled else value)
+                for i, value, pickled in self.connection.execute(
+                    'SELECT id, value, pickled FROM html_nested_tables_leaves '
+                    'WHERE id >= ? AND id < ?',
+                    (start, start + self.page_size)))
+            if len(self.pages) >= self.max_pages:
+                self.pages.popitem(last=False)
+        self.pages[page_number] = page
+        return page[leaf_id]
+
+
+class DiskTableDict(BaseTableDict, Mapping):
+    """
+    Read-only :class:`BaseTableDict` keeping its data in a SQLite database,
+    for tables larger than memory.
+
+    Only keys are kept in memory, with the id of each leaf.  Headers are
+    computed without reading data, and rendering and exporting methods
+    extract data a band of rows at a time, so they do not load the whole
+    table either.  Data is never cached.  It can be rendered from another
+    thread, for example with ``offload=True``.
+
+    Use :func:`build_disk_table_dict` to build one, and :meth:`close` it
+    or use it as a context manager once done.
+
+    :ivar int rows_per_band: Number of rows extracted at a time when
+                             rendering.
+    """
+
+    __slots__ = ('_keys', '_children', '_ids', 'structure', 'rows_per_band',
+                 '_leaves', '_cache')
+
+    def __init__(self, keys, children, ids, structure, leaves,
+                 rows_per_band=1000):
+        self._keys = keys
+        self._children = children
+        self._ids = ids
+        self.structure = structure
+        self.rows_per_band = rows_per_band
+        self._leaves = leaves
+        self._cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes the SQLite database.
+
+        It is shared with all the sub-tables, none of them can be read
+        afterwards.
+        """
+
+        with self._leaves.lock:
+            self._leaves.pages.clear()
+            self._leaves.connection.close()
+
+    @property
+    def direction(self):
+        return self.structure[0].direction
+
+    def _get_index(self):
+        return dict(zip(self._keys, range(len(self._keys))))
+
+    def _header_items(self):
+        # Leaves are ``None``, so no data is read.
+        return zip(self._keys, self._children)
+
+    def _nested_headers(self, side):
+        # Headers are only cached by the root table, nested tables
+        # would otherwise each keep a copy of their part of them.
+        return self._get_headers(side)
+
+    def _get_data(self):
+        # Data is never cached, it may be larger than memory.
+        return self._layout().get_data(self)
+
+    def _get_parallel_bands(self, layout, count):
+        # Bands are at most about ``rows_per_band`` rows.
+        row_count = len(layout.row_prefixes)
+        return layout._get_bands(max(count, -(-row_count //
+                                               self.rows_per_band)))
+
+    def _iter_sparse_cells(self, layout):
+        width = layout.width
+        for first_row, last_row, data in self._iter_data_bands(layout):
+            for i, d in enumerate(data):
+                if d is not None:
+                    yield (first_row + i // width, i % width), d
+
+    def _items_in(self, keys):
+        # Only the leaves in ``keys`` are read.
+        leaves = self._leaves
+        for k, child, leaf_id in zip(self._keys, self._children, self._ids):
+            if k in keys:
+                yield k, leaves[leaf_id] if child is None else child
+
+    def items(self):
+        leaves = self._leaves
+        for k, child, leaf_id in zip(self._keys, self._children, self._ids):
+            yield k, leaves[leaf_id] if child is None else child
+
+    def __getitem__(self, key):
+        i = self._cached('index', self._get_index)[key]
+        child = self._children[i]
+        return self._leaves[self._ids[i]] if child is None else child
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return '<%s %s keys, %r>' % (self.__class__.__name__, len(self),
+                                     self.structure)
+
+
+def _encode_leaf(value):
+    """
+    Returns the ``(value, pickled)`` stored in SQLite for ``value``.
+
+    Types that SQLite would not give back as is are pickled.
+    """
+
+    value_type = type(value)
+    if value_type in (type(None), float, type('')) \
+            or value_type is int and -2 ** 63 <= value < 2 ** 63:
+        return value, 0
+    return pickle.dumps(value, 2), 1
+
+
+def build_disk_table_dict(records, structure, path='', rows_per_band=1000,
+                          batch_size=10000):
+    """
+    Builds a :class:`DiskTableDict` from flat records, in a single pass.
+
+    Records are the same as for :func:`build_table_dict_from_records`.
+    Leaf values are written to SQLite by batches as records are read.
+
+    :arg records: An iterable of ``(path, value)``.
+    :arg structure: Structure of the headers of the returned object.
+    :type structure: list or tuple
+    :arg path: Path of the SQLite database.  Its table of leaves is
+               replaced.  By default, a temporary database deleted when
+               the table is garbage collected.
+    :type path: unicode
+    :arg rows_per_band: Number of rows extracted at a time when rendering.
+    :type rows_per_band: int
+    :arg batch_size: Number of leaves inserted at a time.
+    :type batch_size: int
+    :rtype: DiskTableDict
+    """
+
+    import sqlite3
+
+    # The connection is used by whichever thread renders the table.
+    connection = sqlite3.connect(path, check_same_thread=False)
+    with connection:
+        connection.execute('DROP TABLE IF EXISTS html_nested_tables_leaves')
+        connection.execute(
+            'CREATE TABLE html_nested_tables_leaves '
+            '(id INTEGER PRIMARY KEY, value, pickled INTEGER NOT NULL)')
+
+    def insert(batch):
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO html_nested_tables_leaves '
+                'VALUES (?, ?, ?)', batch)
+
+    # Nested ``OrderedDict`` s of keys, with leaf ids as leaves.
+    root = OrderedDict()
+    leaf_count = 0
+    batch = []
+    for keys, value in records:
+        node = root
+        for key in keys[:-1]:
+            child = node.get(key)
+            if not isinstance(child, OrderedDict):
+                child = node[key] = OrderedDict()
+            node = child
+        leaf_id = node.get(keys[-1])
+        if leaf_id is None or isinstance(leaf_id, OrderedDict):
+            leaf_id = node[keys[-1]] = leaf_count
+            leaf_count += 1
+        batch.append((leaf_id,) + _encode_leaf(value))
+        if len(batch) >= batch_size:
+            insert(batch)
+            batch = []
+    insert(batch)
+
+    structures = [tuple(structure[level:])
+                  for level in range(len(structure))]
+    leaves = _DiskLeaves(connection)
+
+    def build(node, level):
+        children = tuple(
+            build(child, level + 1) if isinstance(child, OrderedDict)
+            else None for child in node.values())
+        ids = array('q', (-1 if isinstance(child, OrderedDict) else child
+                          for child in node.values()))
+        return DiskTableDict(tuple(node), children, ids, structures[level],
+                             leaves, rows_per_band)
+
+    return build(root, 0)
+
+
+def build_table_view(datadict, structure):
+    """
+    Same as :func:`build_table_dict`, but returns a :class:`TableDictView`
+    that does not copy ``datadict``.
+
+    :rtype: TableDictView
+    """
+
+    return TableDictView(datadict, structure)
+
+
+class _ShapeStatistics(object):
+    """
+    Computes header lengths of ``datadict`` for any structure without building
+    :class:`TableDict` s.
+
+    The vertical headers of a table only depend on which levels are vertical,
+    so we compute the headers of one side for a bit mask of levels
+    (``mask & (1 << level)`` is set when ``level`` is on that side).
+    The horizontal headers are the same computation with the inverted mask.
+
+    Headers of each node are memoized per mask of the levels below it, and
+    header lists are interned so that merging them is a matter of comparing
+    integers.  Header items are encoded as ``(0, key)`` for a leaf header and
+    ``(1, key, group_id)`` for a header containing other headers;  these
+    tuples compare exactly like the nested lists of
+    :meth:`TableDict._get_headers`.
+    """
+
+    EMPTY = 0
+
+    def __init__(self, datadict):
+        self.depth = TableDict._get_headers_depth(datadict)
+        self.root = self._get_shape(datadict)
+        self.interned = {(): self.EMPTY}
+        self.headers = [()]
+        self.lengths = [0]
+
+    @classmethod
+    def _get_shape(cls, datadict):
+        # Mirrors ``build_table_dict``: only tuples are nested tables,
+        # and keys follow ``OrderedDict`` semantics.
+        items = [(k, cls._get_shape(v) if isinstance(v, tuple) else None)
+                 for k, v in OrderedDict(datadict).items()]
+        return items, {}
+
+    def _intern(self, headers):
+        headers = tuple(headers)
+        try:
+            return self.interned[headers]
+        except KeyError:
+            headers_id = self.interned[headers] = len(self.headers)
+            self.headers.append(headers)
+            self.lengths.append(sum(
+                1 if item[0] == 0 else self.lengths[item[2]]
+                for item in headers))
+            return headers_id
+
+    def _get_headers(self, node, mask):
+        items, memo = node
+        try:
+            return memo[mask]
+        except KeyError:
+            pass
+        headers = []
+        if mask & 1:
+            for k, child in items:
+                if child is not None:
+                    child_id = self._get_headers(child, mask >> 1)
+                    if child_id != self.EMPTY:
+                        headers.append((1, k, child_id))
+                        continue
+                headers.append((0, k))
+        else:
+            seen = set()
+            for k, child in items:
+                if child is not None:
+                    for item in self.headers[
+                            self._get_headers(child, mask >> 1)]:
+                        if item not in seen:
+                            seen.add(item)
+                            headers.append(item)
+        headers_id = memo[mask] = self._intern(headers)
+        return headers_id
+
+    def get_lengths(self, structure):
+        """
+        Returns the vertical and horizontal lengths of the table that
+        ``build_table_dict(datadict, structure)`` would build.
+        """
+
+        vertical_mask = sum(1 << level for level, table_class
+                            in enumerate(structure)
+                            if table_class.direction == VERTICAL)
+        horizontal_mask = ((1 << len(structure)) - 1) ^ vertical_mask
+        return (self.lengths[self._get_headers(self.root, vertical_mask)],
+                self.lengths[self._get_headers(self.root, horizontal_mask)])
+
+    def get_ugliness(self, structure):
+        """
+        Same as :meth:`TableDict.get_ugliness`.
+        """
+
+        vertical_length, horizontal_length = self.get_lengths(structure)
+        ugliness = vertical_length + horizontal_length
+        ugliness += abs(vertical_length - horizontal_length)
+        return ugliness
+
+
+class StructureMemo(object):
+    """
+    Least recently used optimal structures, by shape fingerprint.
+
+    The ugliness of a table only depends on its headers, so datadicts with
+    the same :func:`get_shape_fingerprint` have the same optimal structure.
+    :func:`get_optimal_structure` uses :data:`OPTIMAL_STRUCTURES` by default.
+
+    >>> memo = StructureMemo()
+    >>> structure = get_optimal_structure((('a', 1),), memo=memo)
+    >>> get_optimal_structure((('a', 2),), memo=memo) == structure
+    True
+    >>> len(memo), memo.hits, memo.misses
+    (1, 1, 1)
+
+    :arg max_size: Maximum number of structures kept.
+    :type max_size: int
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._structures = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._structures)
+
+    def __repr__(self):
+        return '<StructureMemo %s structures, %s hits, %s misses>' % (
+            len(self), self.hits, self.misses)
+
+    def items(self):
+        """
+        Returns the ``(fingerprint, structure)`` pairs, from the least
+        to the most recently used.
+
+        :rtype: list
+        """
+
+        with self._lock:
+            return list(self._structures.items())
+
+    def get(self, fingerprint):
+        """
+        Returns the structure memoized for ``fingerprint``, or ``None``.
+
+        :rtype: tuple or None
+        """
+
+        with self._lock:
+            structure = self._structures.pop(fingerprint, None)
+            if structure is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._structures[fingerprint] = structure
+            return structure
+
+    def set(self, fingerprint, structure):
+        """
+        Memoizes ``structure`` for ``fingerprint``.
+        """
+
+        with self._lock:
+            self._structures.pop(fingerprint, None)
+            self._structures[fingerprint] = tuple(structure)
+            while len(self._structures) > self.max_size:
+                self._structures.popitem(last=False)
+
+    def clear(self):
+        """
+        Forgets all structures and resets counters.
+        """
+
+        with self._lock:
+            self._structures.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+OPTIMAL_STRUCTURES = StructureMemo()
+
+
+# Set in each worker process by ``_init_scoring_worker``.
+_scoring_worker_args = None
+
+
+def _init_scoring_worker(datadict, key):
+    global _scoring_worker_args
+    _scoring_worker_args = (datadict, key)
+
+
+def _score_structure(structure):
+    datadict, key = _scoring_worker_args
+    return key(build_table_dict(datadict, structure))
+
+
+def get_optimal_structure(datadict, key=None, workers=None, stats=None,
+                          memo=OPTIMAL_STRUCTURES):
+    """
+    Returns the structure of the less ugly table possible from ``datadict``.
+
+    By default, ugliness is computed from the shape of ``datadict``, so no
+    table is built.  When several structures are equally ugly, the first one
+    returned by :func:`get_all_structures` wins.
+
+    :arg datadict: Nested dicts or association lists.  Association lists have
+                   the advantage of being ordered.
+    :type datadict: dict or tuple or list
+    :arg key: Custom cost of a table, called with each possible
+              :class:`TableDict`.  Defaults to :meth:`TableDict.get_ugliness`.
+    :type key: callable or None
+    :arg workers: Number of processes scoring tables with ``key``.  ``key``
+                  must then be picklable, e.g. a module-level function.
+                  Only scores are sent back from the processes.  The
+                  default search builds no table, so it never needs them
+                  and ``workers`` requires ``key``.
+    :type workers: int or None
+    :arg stats: Records the time spent searching and the number of
+                candidate structures.
+    :type stats: Stats or None
+    :arg memo: Optimal structures of previous shapes, used when ``key`` is
+               ``None``.  ``None`` disables it.
+    :type memo: StructureMemo or None
+    :returns: A sequence of ``h`` and/or ``v``.
+    :rtype: tuple
+    """
+
+    if key is None and workers is not None:
+        raise ValueError('`workers` requires a custom `key`.')
+    if stats is None:
+        return _get_optimal_structure(datadict, key, workers, memo)
+    with stats.timer('structure_search'):
+        return _get_optimal_structure(datadict, key, workers, memo, stats)
+
+
+def _get_optimal_structure(datadict, key, workers, memo, stats=None):
+    fingerprint = None
+    if key is None and memo is not None:
+        fingerprint = get_shape_fingerprint(datadict)
+        structure = memo.get(fingerprint)
+        if structure is not None:
+            if stats is not None:
+                stats.count('candidates', 0)
+            return structure
+    structure = _search_optimal_structure(datadict, key, workers)
+    if stats is not None:
+        # There is one structure per combination of ``h`` and ``v``
+        # on each level, no need to build them to count them.
+        stats.count('candidates', 2 ** len(structure))
+    if fingerprint is not None:
+        memo.set(fingerprint, structure)
+    return structure
+
+
+def _search_optimal_structure(datadict, key, workers):
+    if key is None:
+        return min(get_all_structures(datadict),
+                   key=_ShapeStatistics(datadict).get_ugliness)
+
     structures = get_all_structures(datadict)
-    tables = [build_table_dict(datadict, structure)
-              for structure in structures]
-    return sorted(tables, key=lambda t: t.get_ugliness())[0]
+
+    if workers is None:
+        scores = [key(build_table_dict(datadict, structure))
+                  for structure in structures]
+    else:
+        chunksize = max(1, len(structures) // (workers * 4))
+        with ProcessPoolExecutor(
+                workers, initializer=_init_scoring_worker,
+                initargs=(datadict, key)) as executor:
+            scores = list(executor.map(_score_structure, structures,
+                                       chunksize=chunksize))
+    # Like ``sorted``, keeps the first structure in case of a tie.
+    best = min(range(len(structures)), key=scores.__getitem__)
+    return structures[best]
+
+
+def build_optimal_table_dict(datadict, key=None, workers=None, stats=None):
+    """
+    Automatically builds the less ugly table possible from ``datadict``.
+
+    :arg datadict: Nested dicts or association lists.  Association lists have
+                   the advantage of being ordered.
+    :type datadict: dict or tuple or list
+    :arg key: See :func:`get_optimal_structure`.
+    :arg workers: See :func:`get_optimal_structure`.
+    :arg stats: Records the time spent searching and building.
+    :type stats: Stats or None
+    :returns: Nested :class:`TableDict` with horizontal and/or vertical
+                  structures applied, according to ``structure``.
+    :rtype: HorizontalTableDict or VerticalTableDict
+    """
+
+    structure = get_optimal_structure(datadict, key=key, workers=workers,
+                                      stats=stats)
+    return build_table_dict(datadict, structure, stats=stats)
+
+
+def build_optimal_table_view(datadict):
+    """
+    Same as :func:`build_optimal_table_dict`, but returns a
+    :class:`TableDictView` that does not copy ``datadict``.
+
+    :rtype: TableDictView
+    """
+
+    return build_table_view(datadict, get_optimal_structure(datadict))
+
+
+def get_shape_fingerprint(datadict):
+    """
+    Returns a hash of the keys of ``datadict``, ignoring data.
+
+    Two datadicts with the same fingerprint have the same headers
+    for any structure, so they can share a :class:`TableLayout`, and the
+    same possible structures.
+
+    :arg datadict: Nested dicts or association lists.  Association lists have
+                   the advantage of being ordered.
+    :type datadict: dict or tuple or list
+    :rtype: unicode
+    """
+
+    hasher = hashlib.sha1()
+    containers = (list, tuple, dict)
+
+    def update(datadict):
+        # Returns the nesting depth of ``datadict``, measured like
+        # ``TableDict._get_headers_depth`` does on the raw datadict.
+        # Like ``build_table_dict``, only tuples are nested tables.
+        items = OrderedDict(datadict)
+        depth = 0
+        for k, v in items.items():
+            # Length prefixes keep a key from mimicking separators.
+            name = type(k).__name__
+            key = '%r' % (k,)
+            hasher.update(('%d:%s%d:%s' % (len(name), name, len(key), key))
+                          .encode('utf-8'))
+            if isinstance(v, tuple):
+                hasher.update(b'(')
+                depth = max(depth, update(v))
+                hasher.update(b')')
+            else:
+                hasher.update(b',')
+                if isinstance(v, containers):
+                    depth = max(depth, _get_nesting_depth(v))
+            if isinstance(k, containers):
+                depth = max(depth, _get_nesting_depth(k))
+        if isinstance(datadict, (list, tuple)) and len(items) == len(datadict):
+            # One level for the pairs, one for ``datadict``.
+            return depth + 2
+        # Values of dicts do not count, values replaced by a duplicate
+        # key do.
+        return _get_nesting_depth(datadict)
+
+    depth = update(datadict)
+    # Datadicts with a different depth have different structures.
+    depth = depth - depth // 2 if datadict else 1
+    hasher.update(('|%d' % depth).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+# Types of keys and data whose levels are pickled by ``get_content_hash``.
+_PICKLED_TYPES = frozenset([type(None), bool, int, float, type(''),
+                            type(2 ** 64)])
+_TUPLE_TYPES = frozenset([tuple])
+
+
+def get_content_hash(datadict, structure=None):
+    """
+    Returns a hash of the keys and data of ``datadict`` and of ``structure``.
+
+    Two datadicts with the same hash render the same HTML table.  Hashing
+    is a single walk of ``datadict``, much cheaper than rendering it.
+
+    :arg datadict: Nested dicts or association lists.
+    :type datadict: dict or tuple or list
+    :arg structure: Structure of the table, or ``None`` for the optimal one.
+    :type structure: list or tuple or None
+    :rtype: unicode
+    """
+
+    # Tokens are bytes, and cannot mimic the separators of other tokens.
+    # Levels whose keys and leaves are of basic types, where most of the
+    # data is, are pickled at once, which is self-delimiting.  Other keys
+    # and leaves are written one by one, prefixed with their length,
+    # and hashed by batches.
+    hasher = hashlib.sha1()
+    tokens = []
+    append = tokens.append
+    # Length-prefixed names of the types met so far.
+    type_names = {}
+    text_type = type('')
+    # Text keys met so far, mostly repeated among siblings:
+    # ``{key: token}``.  Only text keys are cached: other keys may be
+    # equal with different reprs, like 0.0 and -0.0, or 1 and True.
+    key_tokens = {}
+    dumps = pickle.dumps
+    # Pickles of these types tell apart values rendered differently,
+    # like 1, True, '1', 1.0 and -0.0.  Equal values may be pickled
+    # differently when some are the same object, which only costs
+    # a cache miss.
+    pickled_types = _PICKLED_TYPES.issuperset
+
+    def get_type_name(value_type):
+        name = value_type.__name__
+        name = type_names[value_type] = '%d:%s' % (len(name), name)
+        return name
+
+    def get_key_token(k):
+        key = '%r' % (k,)
+        token = ('%s%d:%s' % (
+            type_names.get(type(k)) or get_type_name(type(k)),
+            len(key), key)).encode('utf-8')
+        if type(k) is text_type:
+            key_tokens[k] = token
+        return token
+
+    def write_pickle(tag, value):
+        # Pickles are large, they are hashed right away.
+        if tokens:
+            append(tag)
+            hasher.update(b''.join(tokens))
+            del tokens[:]
+        else:
+            hasher.update(tag)
+        hasher.update(dumps(value, 2))
+
+    def update(datadict):
+        if len(tokens) >= 4096:
+            hasher.update(b''.join(tokens))
+            del tokens[:]
+        if type(datadict) is not tuple and isinstance(datadict, Mapping):
+            items = tuple(datadict.items())
+        elif len(dict(datadict)) < len(datadict):
+            # Duplicate keys are collapsed like in ``build_table_dict``.
+            items = tuple(OrderedDict(datadict).items())
+        else:
+            items = datadict
+        if items:
+            keys, values = zip(*items)
+            if pickled_types(map(type, keys)):
+                value_types = set(map(type, values))
+                if pickled_types(value_types):
+                    write_pickle(b'L', (keys, values))
+                    return
+                if value_types == _TUPLE_TYPES:
+                    # Followed by one nested table per key.
+                    write_pickle(b'N', keys)
+                    for v in values:
+                        update(v)
+                    return
+                if pickled_types(value_types - _TUPLE_TYPES):
+                    # Nested tables are replaced by ``()``, which is not
+                    # a leaf, and follow.
+                    write_pickle(b'M', (keys, tuple([
+                        () if type(v) is tuple else v for v in values])))
+                    for v in values:
+                        if type(v) is tuple:
+                            update(v)
+                    return
+        append(b'(')
+        for k, v in items:
+            if type(k) is text_type:
+                key = key_tokens.get(k) or get_key_token(k)
+            else:
+                key = get_key_token(k)
+            append(key)
+            if isinstance(v, tuple):
+                append(b'(')
+                update(v)
+                append(b')')
+            else:
+                # Data is rendered with ``%s``, its type tells None from
+                # 'None'.
+                value = '%s' % (v,)
+                append(('=%s%d:%s' % (
+                    type_names.get(type(v)) or get_type_name(type(v)),
+                    len(value), value)).encode('utf-8'))
+        append(b')')
+
+    update(datadict)
+    if structure is None:
+        append(b'|optimal')
+    else:
+        append(('|' + ','.join(table_class.direction
+                               for table_class in structure)).encode('utf-8'))
+    hasher.update(b''.join(tokens))
+    return hasher.hexdigest()
+
+
+def render_many_iter(datadicts, structure=None):
+    """
+    Renders HTML tables from ``datadicts``, in the same order.
+
+    The optimal structure and the :class:`TableLayout` are computed once per
+    distinct shape of datadict, see :func:`get_shape_fingerprint`.
+
+    :arg datadicts: An iterable of datadicts.
+    :arg structure: Structure of all tables.  If ``None``, the optimal
+                    structure of each shape is used.
+    :type structure: list or tuple or None
+    :returns: A generator of HTML tables.
+    :rtype: generator of unicode
+    """
+
+    layouts = {}
+    for datadict in datadicts:
+        fingerprint = get_shape_fingerprint(datadict)
+        layout = layouts.get(fingerprint)
+        if layout is None:
+            table_dict = build_table_dict(
+                datadict, structure or get_optimal_structure(datadict))
+            layout = layouts[fingerprint] = compile_layout(table_dict)
+        else:
+            table_dict = build_table_dict(datadict, layout.structure)
+        yield layout.generate_html(table_dict)
+
+
+def _get_product_headers(labels):
+    """
+    Returns the headers of the cartesian product of ``labels``, a sequence
+    of label sequences.  Groups of a level are the same object.
+    """
+
+    if not labels:
+        return []
+    headers = list(labels[-1])
+    for level_labels in reversed(labels[:-1]):
+        headers = [[label, headers] for label in level_labels]
+    return headers
+
+
+def render_array(array, labels, structure, cell_format=None):
+    """
+    Generates an HTML table from a dense N-dimensional array.
+
+    This renders the same table as :func:`build_table_dict` on the
+    equivalent nested association lists, without building them: headers
+    are the product of ``labels``, and data is reordered and converted
+    to Python objects for the whole array at once.  NaN and masked
+    entries are rendered as empty cells.  Cells are then formatted by
+    Python like other tables: formatting them with NumPy is slower for
+    floats, and hardly faster for integers.
+
+    Requires NumPy.
+
+    :arg array: An array, or a :class:`numpy.ma.MaskedArray`.
+    :type array: numpy.ndarray
+    :arg labels: A sequence of header labels for each axis of ``array``.
+    :type labels: list or tuple
+    :arg structure: Structure of the table, one ``h`` or ``v`` per axis
+                    of ``array``.
+    :type structure: list or tuple
+    :arg cell_format: See :meth:`TableDict.generate_html_iter`.
+    :type cell_format: CellFormat or None
+    :returns: A HTML table.
+    :rtype: unicode
+    """
+
+    import numpy
+
+    array = numpy.ma.asanyarray(array)
+    if not array.ndim == len(labels) == len(structure):
+        raise ValueError('`labels` and `structure` must have one item '
+                         'per axis of `array`.')
+    labels = [[label.item() if isinstance(label, numpy.generic) else label
+               for label in axis_labels] for axis_labels in labels]
+    if tuple(map(len, labels)) != array.shape:
+        raise ValueError('`labels` must have one label per index '
+                         'of each axis of `array`.')
+
+    vertical_axes = [axis for axis, table_class in enumerate(structure)
+                     if table_class.direction == VERTICAL]
+    horizontal_axes = [axis for axis, table_class in enumerate(structure)
+                       if table_class.direction == HORIZONTAL]
+    layout = TableLayout(
+        structure, _get_product_headers([labels[a] for a in horizontal_axes]),
+        _get_product_headers([labels[a] for a in vertical_axes]),
+        _get_header_formatter(cell_format))
+
+    values = numpy.ma.getdata(array)
+    missing = numpy.ma.getmaskarray(array)
+    if values.dtype.kind in 'fc':
+        missing = missing | numpy.isnan(values)
+    # Object arrays hold Python numbers, formatted like in association lists.
+    values = values.astype(object)
+    values[missing] = None
+    data = values.transpose(vertical_axes + horizontal_axes).ravel().tolist()
+    return ''.join(layout._iter_html(data, cell_format))
+
+
+def render_many(datadicts, structure=None):
+    """
+    Same as :func:`render_many_iter`, but returns a list.
+
+    :rtype: list of unicode
+    """
+
+    return list(render_many_iter(datadicts, structure))
+
+
+class RenderCache(object):
+    """
+    Cache of rendered HTML tables, addressed by :func:`get_content_hash`.
+
+    The most recently used tables are kept in memory, up to ``max_size``
+    characters of HTML.  If ``path`` is given, rendered tables are also
+    stored in a SQLite database, so that they survive process restarts,
+    up to ``max_disk_size`` characters of HTML.  The tables least recently
+    read from or written to the database are deleted first.  It can be
+    used from several threads.
+
+    >>> cache = RenderCache()
+    >>> html = cache.get_html(((1, ((2, 3),)),))
+    >>> cache.get_html(((1, ((2, 3),)),)) == html
+    True
+    >>> cache.hits, cache.misses
+    (1, 1)
+
+    :arg max_size: Total length of HTML kept in memory.
+    :type max_size: int
+    :arg path: Path of the SQLite database, or ``None`` to only cache
+               in memory.
+    :type path: unicode or None
+    :arg max_disk_size: Total length of HTML kept in the database.
+    :type max_disk_size: int
+    """
+
+    def __init__(self, max_size=2 ** 24, path=None, max_disk_size=2 ** 30):
+        self.max_size = max_size
+        self.max_disk_size = max_disk_size
+        self.size = 0
+        self.disk_size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection = None
+        # Last ``used`` of the database rows.
+        self._clock = 0
+        if path is not None:
+            import sqlite3
+            # Accesses are serialized by ``_lock``.
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            with self._connection:
+                columns = [row[1] for row in self._connection.execute(
+                    'PRAGMA table_info(html_tables)')]
+                if columns and 'used' not in columns:
+                    # Created by a version without a size limit.
+                    self._connection.execute('DROP TABLE html_tables')
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS html_tables '
+                    '(key TEXT PRIMARY KEY, html TEXT NOT NULL, '
+                    'size INTEGER NOT NULL, used INTEGER NOT NULL)')
+                self._connection.execute(
+                    'CREATE INDEX IF NOT EXISTS html_tables_used '
+                    'ON html_tables (used)')
+            self.disk_size, self._clock = self._connection.execute(
+                'SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) '
+                'FROM html_tables').fetchone()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<RenderCache %s tables, %s hits, %s disk hits, %s misses>' % (
+            len(self), self.hits, self.disk_hits, self.misses)
+
+    def _remember(self, key, html):
+        if len(html) > self.max_size:
+            return
+        self.size += len(html)
+        self._entries[key] = html
+        while self.size > self.max_size:
+            self.size -= len(self._entries.popitem(last=False)[1])
+
+    def _store(self, key, html):
+        connection = self._connection
+        self._clock += 1
+        with connection:
+            row = connection.execute(
+                'SELECT size FROM html_tables WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self.disk_size -= row[0]
+            if len(html) > self.max_disk_size:
+                connection.execute('DELETE FROM html_tables WHERE key = ?',
+                                   (key,))
+                return
+            connection.execute(
+                'INSERT OR REPLACE INTO html_tables VALUES (?, ?, ?, ?)',
+                (key, html, len(html), self._clock))
+            self.disk_size += len(html)
+            while self.disk_size > self.max_disk_size:
+                old_key, size = connection.execute(
+                    'SELECT key, size FROM html_tables '
+                    'ORDER BY used LIMIT 1').fetchone()
+                connection.execute('DELETE FROM html_tables WHERE key = ?',
+                                   (old_key,))
+                self.disk_size -= size
+
+    def get(self, key):
+        """
+        Returns the HTML cached under ``key``, or ``None``.
+
+        :arg key: A hash returned by :func:`get_content_hash`.
+        :type key: unicode
+        :rtype: unicode or None
+        """
+
+        with self._lock:
+            html = self._entries.pop(key, None)
+            if html is not None:
+                self.hits += 1
+                # Marks it as the most recently used.
+                self._entries[key] = html
+                return html
+            if self._connection is not None:
+                row = self._connection.execute(
+                    'SELECT html FROM html_tables WHERE key = ?',
+                    (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    self._clock += 1
+                    with self._connection:
+                        self._connection.execute(
+                            'UPDATE html_tables SET used = ? WHERE key = ?',
+                            (self._clock, key))
+                    self._remember(key, row[0])
+                    return row[0]
+            self.misses += 1
+
+    def set(self, key, html):
+        """
+        Caches ``html`` under ``key``.
+
+        :arg key: A hash returned by :func:`get_content_hash`.
+        :type key: unicode
+        :arg html: A HTML table.
+        :type html: unicode
+        """
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._remember(key, html)
+            if self._connection is not None:
+                self._store(key, html)
+
+    def get_html(self, datadict, structure=None):
+        """
+        Returns the HTML table of ``datadict``, rendering it only if it is
+        not cached.
+
+        :arg datadict: Nested dicts or association lists.
+        :type datadict: dict or tuple or list
+        :arg structure: Structure of the table.  If ``None``, the optimal
+                        structure is used, like
+                        :func:`build_optimal_table_dict`.
+        :type structure: list or tuple or None
+        :returns: A HTML table.
+        :rtype: unicode
+        """
+
+        key = get_content_hash(datadict, structure)
+        html = self.get(key)
+        if html is None:
+            if structure is None:
+                table_dict = build_optimal_table_dict(datadict)
+            else:
+                table_dict = build_table_dict(datadict, structure)
+            html = table_dict.generate_html()
+            self.set(key, html)
+        return html
+
+    def clear(self):
+        """
+        Empties the cache, including the SQLite database.
+        """
+
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute('DELETE FROM html_tables')
+                self.disk_size = 0
+
+    def close(self):
+        """
+        Closes the SQLite database, if any.
+        """
+
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
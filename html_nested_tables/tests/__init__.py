@@ -1 +1,7 @@
-from .base import Level1TableTest, Level2TableTest, MixedLevelsTableTest
\ No newline at end of file
+from .base import Level1TableTest, Level2TableTest, MixedLevelsTableTest, \
+    CacheTest, HeadersTest, OptimalStructureTest, StreamingTest, \
+    LayoutTest, StatsTest, PatchTest, \
+    ViewTest, WindowTest, AsyncTest, RenderCacheTest, \
+    GridTest, RecordsTest, ArrayTest, CellFormatTest, \
+    FrozenTest, DiskTest, StructureMemoTest, ParallelTest, \
+    SparseTest
@@ -1,8 +1,41 @@
 # coding: utf-8
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import copy
+from decimal import Decimal
+import io
+import json
 import os.path
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+from timeit import default_timer
+import tracemalloc
 import unittest
-from html_nested_tables import build_optimal_table_dict, build_table_dict, h, v
+from html_nested_tables import (
+    CellFormat, CompactTableDict, OPTIMAL_STRUCTURES, StructureMemo,
+    TableDict,
+    build_optimal_table_dict, build_optimal_table_view,
+    build_compact_table_dict, build_disk_table_dict, build_table_dict,
+    build_table_dict_from_records, build_table_view,
+    compile_layout,
+    get_all_structures, get_content_hash, get_optimal_structure,
+    get_shape_fingerprint, render_array, render_many, render_many_iter,
+    RenderCache,
+    Stats, h, v)
+from html_nested_tables.base import _get_parallel_executor
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import asyncio
+    from html_nested_tables import build_optimal_table_dict_async
+except (ImportError, SyntaxError):
+    asyncio = None
 
 
 PATH = os.path.abspath(os.path.dirname(__file__))
@@ -121,5 +154,1383 @@ class MixedLevelsTableTest(TableTest):
     #                             'level_mixed_optimal.html')
 
 
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (
+            ('a', (
+                ('aa', 11),
+                ('ab', 12),
+            )),
+            ('b', (
+                ('ba', 21),
+            )),
+        )
+        self.table = build_table_dict(self.data, (h, v))
+
+    def assertFresh(self, table):
+        fresh = build_table_dict(tuple(
+            (k, tuple(child.items()) if isinstance(child, TableDict)
+             else child) for k, child in table.items()), table.structure)
+        self.assertEqual(table.horizontal_headers(),
+                         fresh.horizontal_headers())
+        self.assertEqual(table.vertical_headers(), fresh.vertical_headers())
+        self.assertEqual(table.generate_html(), fresh.generate_html())
+
+    def testCacheHit(self):
+        headers = self.table.horizontal_headers()
+        self.assertIs(self.table.horizontal_headers(), headers)
+        data = self.table._get_data()
+        self.assertIs(self.table._get_data(), data)
+
+    def testSetItem(self):
+        self.table.generate_html()
+        self.table['c'] = v((('ca', 31),))
+        self.assertEqual(self.table.horizontal_headers(), ['a', 'b', 'c'])
+        self.assertFresh(self.table)
+
+    def testNestedSetItem(self):
+        self.table.generate_html()
+        self.table['a']['ac'] = 13
+        self.assertEqual(self.table.vertical_headers(),
+                         ['aa', 'ab', 'ac', 'ba'])
+        self.assertFresh(self.table)
+
+    def testBuiltLinks(self):
+        # The first nested table of ``'a'`` is replaced while building.
+        table = build_table_dict(
+            (('a', (('aa', 11),)), ('a', (('ab', 12),))), (h, v))
+        table.generate_html()
+        table['a']['ac'] = 13
+        self.assertEqual(table.vertical_headers(), ['ab', 'ac'])
+        self.assertFresh(table)
+
+    def testNestedUpdate(self):
+        self.table.generate_html()
+        self.table['b'].update([('ba', 210)])
+        self.assertIn('<td>210</td>', self.table.generate_html())
+        self.assertFresh(self.table)
+
+    def testDelItem(self):
+        self.table.generate_html()
+        del self.table['a']['ab']
+        self.assertFresh(self.table)
+        del self.table['b']
+        self.assertFresh(self.table)
+
+    def testReplacedChild(self):
+        child = self.table['b']
+        self.table['b'] = v((('bb', 22),))
+        self.table.generate_html()
+        child['bz'] = 0
+        self.assertNotIn('bz', self.table.generate_html())
+
+    def testListStructure(self):
+        table = build_table_dict(self.data, [h, v])
+        self.assertEqual(table.generate_html(), self.table.generate_html())
+        table['a']['aa'] = 10
+        self.assertIn('<td>10</td>', table.generate_html())
+
+
+class HeadersTest(unittest.TestCase):
+    def testMerge(self):
+        data = (
+            ('1901', (
+                ('maison', (('hommes', 1), ('femmes', 2))),
+                ('quartier', (('garçons', (('moins', 1), ('plus', 2))),)),
+            )),
+            ('1902', (
+                ('quartier', (('garçons', (('moins', 1), ('plus', 2))),)),
+                ('prison', 3),
+                ('maison', (('hommes', 1), ('enfants', 2))),
+            )),
+        )
+        table = build_table_dict(data, (v, h, h, h))
+        self.assertEqual(table.horizontal_headers(), [
+            ['maison', ['hommes', 'femmes']],
+            ['quartier', [['garçons', ['moins', 'plus']]]],
+            'prison',
+            ['maison', ['hommes', 'enfants']],
+        ])
+        self.assertEqual(table.vertical_headers(), ['1901', '1902'])
+
+    def testMergeMany(self):
+        # Enough headers to merge them with a set.
+        data = tuple(
+            ('%s' % i, tuple(('%s' % j, (('x', i), ('%s' % (j % 2), j)))
+                             for j in range(i, i + 12)))
+            for i in range(3))
+        table = build_table_dict(data, (v, h, h))
+        self.assertEqual(table.horizontal_headers(), [
+            ['%s' % j, ['x', '%s' % (j % 2)]] for j in range(14)])
+
+
+class OptimalStructureTest(unittest.TestCase):
+    def setUp(self):
+        self.datadicts = [
+            (('a', 1), ('b', 2), ('c', 3)),
+            (('a', (('aa', 11), ('ab', 12))), ('b', (('ba', 21),))),
+            (('a', (('aa', 11), ('ab', 12))), ('b', 2)),
+            (
+                ('1902', (
+                    ('maison', (('hommes', 80), ('femmes', 40))),
+                    ('quartier', (
+                        ('hommes', 12),
+                        ('garçons', (('moins', 1), ('plus', 2))),
+                    )),
+                )),
+                ('1903', (
+                    ('maison', (('hommes', 70), ('jeunes filles', 2))),
+                    ('quartier', (
+                        ('garçons', (('moins', 1), ('plus', 3))),
+                    )),
+                )),
+            ),
+        ]
+
+    def testSameAsExhaustiveSearch(self):
+        for datadict in self.datadicts:
+            tables = [build_table_dict(datadict, structure)
+                      for structure in get_all_structures(datadict)]
+            expected = sorted(tables, key=lambda t: t.get_ugliness())[0]
+            self.assertEqual(tuple(get_optimal_structure(datadict)),
+                             tuple(expected.structure))
+            self.assertEqual(
+                build_optimal_table_dict(datadict).generate_html(),
+                expected.generate_html())
+
+    def testCustomKey(self):
+        for datadict in self.datadicts:
+            tables = [build_table_dict(datadict, structure)
+                      for structure in get_all_structures(datadict)]
+            expected = sorted(tables, key=get_width)[0]
+            self.assertEqual(
+                tuple(get_optimal_structure(datadict, key=get_width)),
+                tuple(expected.structure))
+
+    def testWorkers(self):
+        datadict = self.datadicts[-1]
+        self.assertEqual(
+            get_optimal_structure(datadict, key=get_width, workers=2),
+            get_optimal_structure(datadict, key=get_width))
+        with self.assertRaises(ValueError):
+            get_optimal_structure(datadict, workers=2)
+
+
+def get_width(table):
+    # Module-level, so that it can be sent to worker processes.
+    return len(table._horizontal_accessors())
+
+
+class StreamingTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (
+            ('a', (
+                ('aa', 11),
+                ('ab', 12),
+            )),
+            ('b', 2),
+        )
+
+    def testChunks(self):
+        for structure in get_all_structures(self.data):
+            table = build_table_dict(self.data, structure)
+            chunks = list(table.generate_html_iter())
+            self.assertEqual(''.join(chunks), table.generate_html())
+            self.assertTrue(len(chunks) > 1)
+
+    def testBands(self):
+        data = tuple(('%s' % i, tuple(('%s' % j, i * j) for j in range(3)))
+                     for i in range(10))
+        for structure in get_all_structures(data):
+            expected = build_table_dict(data, structure).generate_html()
+            table = build_table_dict(data, structure)
+            table.rows_per_band = 3
+            chunks = table.generate_html_iter()
+            first_chunk = next(chunks)
+            self.assertNotIn(('data', structure), table._cache)
+            self.assertEqual(table.get_grid(),
+                             build_table_dict(data, structure).get_grid())
+            self.assertEqual(first_chunk + ''.join(chunks), expected)
+            self.assertEqual(table.generate_html(Stats()), expected)
+            self.assertNotIn(('data', structure), table._cache)
+            # Frozen tables keep their data.
+            table.freeze()
+            self.assertIn(('data', structure), table._cache)
+            self.assertEqual(table.generate_html(), expected)
+
+    def testWriteHTML(self):
+        table = build_table_dict(self.data, (h, h))
+        f = io.StringIO()
+        table.write_html(f)
+        self.assertEqual(f.getvalue(), table.generate_html())
+        f = io.BytesIO()
+        table.write_html(f, encoding='utf-8')
+        self.assertEqual(f.getvalue(), table.generate_html().encode('utf-8'))
+
+
+class LayoutTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (
+            ('1902', (
+                ('maison', (('hommes', 80), ('femmes', 40))),
+                ('quartier', (('hommes', 12), ('femmes', 3))),
+            )),
+            ('1903', (
+                ('maison', (('hommes', 70), ('femmes', 38))),
+                ('quartier', (('hommes', 5),)),
+            )),
+        )
+        self.other_data = (
+            ('1902', (
+                ('maison', (('hommes', 1), ('femmes', 2))),
+                ('quartier', (('hommes', 3), ('femmes', 4))),
+            )),
+            ('1903', (
+                ('maison', (('hommes', 5), ('femmes', 6))),
+                ('quartier', (('hommes', 7),)),
+            )),
+        )
+
+    def testReuse(self):
+        for structure in get_all_structures(self.data):
+            layout = compile_layout(build_table_dict(self.data, structure))
+            other = build_table_dict(self.other_data, structure)
+            self.assertEqual(layout.generate_html(other),
+                             other.generate_html())
+
+    def testData(self):
+        data = (('a', (('aa', 11), ('ab', 12))), ('b', 2))
+        self.assertEqual(build_table_dict(data, (v, v))._get_data(),
+                         [11, 12, 2])
+        self.assertEqual(build_table_dict(data, (h, v))._get_data(),
+                         [11, None, 12, None])
+        self.assertEqual(build_table_dict(data, (v, h))._get_data(),
+                         [11, 12, None, None])
+
+    def testFingerprintKeys(self):
+        # Without length prefixes, this key would be written like
+        # the two keys 'a' and 'b'.
+        key = type(str('str'), (object,),
+                   {'__repr__': lambda self: "'a',str:'b'"})()
+        self.assertNotEqual(get_shape_fingerprint(((key, 1),)),
+                            get_shape_fingerprint((('a', 1), ('b', 1))))
+
+    def testRenderMany(self):
+        datadicts = [self.data, self.other_data[:1], self.other_data]
+        self.assertEqual(get_shape_fingerprint(self.data),
+                         get_shape_fingerprint(self.other_data))
+        self.assertNotEqual(get_shape_fingerprint(self.data),
+                            get_shape_fingerprint(self.other_data[:1]))
+        self.assertEqual(
+            render_many(datadicts),
+            [build_optimal_table_dict(d).generate_html() for d in datadicts])
+        self.assertEqual(
+            list(render_many_iter(datadicts, (v, h, v))),
+            [build_table_dict(d, (v, h, v)).generate_html()
+             for d in datadicts])
+
+    def testTupleKeys(self):
+        data = (('x', (((2020, 1), 5), ((2020, 2), 6))),)
+        string_data = (('x', (('(2020, 1)', 5), ('(2020, 2)', 6))),)
+        for structure in get_all_structures(data):
+            table = build_table_dict(data, structure)
+            string_table = build_table_dict(string_data, structure)
+            self.assertEqual(table.generate_html(),
+                             string_table.generate_html())
+            self.assertEqual(table.get_grid(), string_table.get_grid())
+
+    def testImmutable(self):
+        layout = compile_layout(build_table_dict(self.data, (v, h, h)))
+        with self.assertRaises(AttributeError):
+            layout.width = 2
+
+    def testStructureMismatch(self):
+        layout = compile_layout(build_table_dict(self.data, (v, h, h)))
+        with self.assertRaises(ValueError):
+            layout.generate_html(build_table_dict(self.data, (h, h, h)))
+
+
+class WindowTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (
+            ('1902', (
+                ('maison', (('hommes', 80), ('femmes', 40))),
+                ('quartier', (('hommes', 12), ('femmes', 3))),
+            )),
+            ('1903', (
+                ('maison', (('hommes', 70), ('femmes', 38))),
+                ('quartier', (('hommes', 5),)),
+            )),
+        )
+
+    def testWholeWindow(self):
+        for structure in get_all_structures(self.data):
+            table = build_table_dict(self.data, structure)
+            self.assertEqual(table.generate_html_window(),
+                             table.generate_html())
+            self.assertEqual(
+                table.generate_html_window(slice(None), slice(0, 1000)),
+                table.generate_html())
+
+    def testWindow(self):
+        table = build_table_dict(self.data, (v, v, h))
+        self.assertEqual(
+            table.generate_html_window(slice(1, 3), slice(1, 3)),
+            '<table><tr><td colspan="2" rowspan="1" '
+            'style="border: none;"></td><th rowspan="1">femmes</th>'
+            '</tr><tr><th rowspan="1">1902</th>'
+            '<th colspan="1">quartier</th><td>3</td>'
+            '</tr><tr><th rowspan="1">1903</th>'
+            '<th colspan="1">maison</th><td>38</td></table>')
+
+    def testHorizontalWindow(self):
+        table = build_table_dict(self.data, (h, h, v))
+        self.assertEqual(
+            table.generate_html_window(columns=slice(1, 3)),
+            '<table><tr><td colspan="1" rowspan="2" '
+            'style="border: none;"></td><th colspan="1">1902</th>'
+            '<th colspan="1">1903</th></tr><tr>'
+            '<th rowspan="1">quartier</th><th rowspan="1">maison</th>'
+            '</tr><tr><th colspan="1">hommes</th><td>12</td><td>70</td>'
+            '</tr><tr><th colspan="1">femmes</th><td>3</td><td>38</td>'
+            '</table>')
+
+    def testInvalidWindow(self):
+        table = build_table_dict(self.data, (v, v, h))
+        with self.assertRaises(ValueError):
+            table.generate_html_window(slice(0, 4, 2))
+
+
+def run_async_iter(iterator):
+    loop = asyncio.new_event_loop()
+    items = []
+    try:
+        while True:
+            try:
+                items.append(loop.run_until_complete(iterator.__anext__()))
+            except StopAsyncIteration:
+                return items
+    finally:
+        loop.close()
+
+
+@unittest.skipIf(asyncio is None, 'asyncio rendering requires Python 3.6+')
+class AsyncTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (
+            ('1902', (
+                ('maison', (('hommes', 80), ('femmes', 40))),
+                ('quartier', (('hommes', 12), ('femmes', 3))),
+            )),
+            ('1903', (
+                ('maison', (('hommes', 70), ('femmes', 38))),
+                ('quartier', (('hommes', 5),)),
+            )),
+        )
+
+    def testChunks(self):
+        for structure in get_all_structures(self.data):
+            table = build_table_dict(self.data, structure)
+            for cells in (1, 3, 1000):
+                chunks = run_async_iter(table.generate_html_async(cells))
+                self.assertEqual(''.join(chunks), table.generate_html())
+                for chunk in chunks:
+                    self.assertLessEqual(chunk.count('<td>'), cells)
+
+    def testOffload(self):
+        table = build_table_dict(self.data, (v, v, h))
+        chunks = run_async_iter(table.generate_html_async(offload=True))
+        self.assertEqual(''.join(chunks), table.generate_html())
+
+    def testBuildOptimal(self):
+        loop = asyncio.new_event_loop()
+        try:
+            table = loop.run_until_complete(
+                build_optimal_table_dict_async(self.data))
+        finally:
+            loop.close()
+        self.assertEqual(table.generate_html(),
+                         build_optimal_table_dict(self.data).generate_html())
+
+
+class ViewTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (
+            ('a', (
+                ('aa', 11),
+                ('ab', 12),
+            )),
+            ('b', 2),
+            ('c', (
+                ('ca', 31),
+                ('aa', 32),
+            )),
+            ('c', (
+                ('cb', 33),
+            )),
+        )
+
+    def testSameAsTableDict(self):
+        for structure in get_all_structures(self.data):
+            table = build_table_dict(self.data, structure)
+            view = build_table_view(self.data, structure)
+            self.assertEqual(view.generate_html(), table.generate_html())
+            self.assertEqual(view.get_ugliness(), table.get_ugliness())
+        self.assertEqual(build_optimal_table_view(self.data).generate_html(),
+                         build_optimal_table_dict(self.data).generate_html())
+
+    def testNoCopy(self):
+        view = build_table_view(self.data, (v, h))
+        self.assertEqual(list(view), ['a', 'b', 'c'])
+        self.assertIs(view['a']._datadict, self.data[0][1])
+        self.assertEqual(view['c']['cb'], 33)
+        self.assertIsNone(view['a']._index)
+
+    def testNoIndexWhenRendering(self):
+        data = self.data[:3]
+        for structure in get_all_structures(data):
+            view = build_table_view(data, structure)
+            self.assertEqual(view.generate_html(),
+                             build_table_dict(data, structure).generate_html())
+            self.assertIsNone(view._index)
+
+    def testNoNestedState(self):
+        data = tuple(
+            ('%s' % i, tuple(('%s' % j, tuple(('%s' % k, k) for k in range(4)))
+                             for j in range(10)))
+            for i in range(10))
+
+        def get_retained_size(build):
+            tracemalloc.start()
+            try:
+                table = build(data, (v, h, v))
+                table.generate_html()
+                table.get_ugliness()
+                return tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+
+        view = build_table_view(data, (v, h, v))
+        view.generate_html()
+        self.assertFalse(hasattr(view, '__dict__'))
+        self.assertLess(get_retained_size(build_table_view) * 2,
+                        get_retained_size(build_table_dict))
+
+    def testCompact(self):
+        labels = {}
+        for structure in get_all_structures(self.data):
+            table = build_table_dict(self.data, structure)
+            compact = build_compact_table_dict(self.data, structure, labels)
+            self.assertEqual(compact.generate_html(), table.generate_html())
+            self.assertEqual(compact.get_ugliness(), table.get_ugliness())
+        label = ''.join(['a', 'a'])
+        other = build_compact_table_dict(((label, 1),), (h,), labels)
+        self.assertIsNot(label, labels['aa'])
+        self.assertIs(list(other)[0], labels['aa'])
+        self.assertFalse(hasattr(other, '__dict__'))
+
+    def testCompactNoNestedCache(self):
+        for structure in get_all_structures(self.data):
+            compact = build_compact_table_dict(self.data, structure)
+            compact.generate_html()
+            compact.get_ugliness()
+            self.assertIsNotNone(compact._cache)
+            nodes = list(compact.values())
+            while nodes:
+                node = nodes.pop()
+                if isinstance(node, CompactTableDict):
+                    self.assertIsNone(node._cache)
+                    nodes.extend(node.values())
+
+    def testCompactLabelTypes(self):
+        labels = {}
+        for data in (((1, 10),), ((True, 20),), ((1.0, 30),), (('1', 40),)):
+            table = build_table_dict(data, (h,))
+            compact = build_compact_table_dict(data, (h,), labels)
+            self.assertEqual(compact.generate_html(), table.generate_html())
+        self.assertEqual(list(labels), ['1'])
+
+    def testCompactEqualLabels(self):
+        labels = {}
+        for key, other_key in ((0.0, -0.0),
+                               (Decimal('1.0'), Decimal('1.00'))):
+            data = (('a', ((key, 1),)), ('b', ((other_key, 2),)))
+            for structure in get_all_structures(data):
+                compact = build_compact_table_dict(data, structure, labels)
+                self.assertEqual(
+                    compact.generate_html(),
+                    build_table_dict(data, structure).generate_html())
+
+
+class PatchTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (
+            ('1902', (
+                ('maison', (('hommes', 80), ('femmes', 40))),
+                ('quartier', (
+                    ('hommes', 12),
+                    ('garçons', (('moins', 1), ('plus', 2))),
+                )),
+            )),
+            ('1903', (
+                ('maison', (('hommes', 70), ('jeunes filles', 2))),
+                ('quartier', (
+                    ('garçons', (('moins', 1), ('plus', 3))),
+                )),
+            )),
+        )
+        self.paths = (('1902', 'maison', 'femmes'),
+                      ('1903', 'quartier', 'garçons', 'plus'),
+                      ('1902', 'quartier', 'hommes'))
+
+    def testPatches(self):
+        for structure in get_all_structures(self.data):
+            table = build_table_dict(self.data, structure)
+            table.track_changes()
+            cells = list(table._get_data())
+            width = len(table._horizontal_accessors()) or 1
+            for i, path in enumerate(self.paths):
+                node = table
+                for key in path[:-1]:
+                    node = node[key]
+                node[path[-1]] = 100 + i
+            patches = table.get_patches()
+            self.assertTrue(patches)
+            for row, column, html in patches:
+                cells[row * width + column] = html[4:-5]
+            fresh = build_table_dict(table_to_datadict(table), structure)
+            self.assertEqual(
+                ['-' if d is None else '%s' % d for d in cells],
+                ['-' if d is None else '%s' % d for d in fresh._get_data()])
+            self.assertEqual(table.generate_html(), fresh.generate_html())
+            self.assertEqual(table.get_patches(), [])
+
+    def testRowPatches(self):
+        table = build_table_dict(self.data, (v, v, h, h))
+        table.track_changes()
+        table['1903']['maison']['hommes'] = 71
+        (row, html), = table.get_row_patches()
+        self.assertEqual(row, 2)
+        self.assertEqual(html, '<tr><th rowspan="2">1903</th>'
+                               '<th colspan="1">maison</th><td>71</td>'
+                               '<td>-</td><td>-</td><td>-</td><td>2</td>'
+                               '</tr>')
+
+    def testShapeChange(self):
+        table = build_table_dict(self.data, (v, v, h, h))
+        table.track_changes()
+        table['1903']['maison']['femmes'] = 1
+        self.assertIsNone(table.get_patches())
+
+
+def table_to_datadict(table):
+    return tuple((k, table_to_datadict(child)
+                  if isinstance(child, TableDict) else child)
+                 for k, child in table.items())
+
+
+class StatsTest(unittest.TestCase):
+    def testPhases(self):
+        data = (('a', (('aa', 11), ('ab', 12))), ('b', (('ba', 21),)))
+        phases = []
+        stats = Stats(callback=lambda phase, seconds: phases.append(phase))
+        OPTIMAL_STRUCTURES.clear()
+        table = build_optimal_table_dict(data, stats=stats)
+        html = table.generate_html(stats=stats)
+        self.assertEqual(html, build_optimal_table_dict(data).generate_html())
+        self.assertEqual(phases, ['structure_search', 'build', 'headers',
+                                  'layout', 'data', 'html'])
+        self.assertEqual(stats.calls['html'], 1)
+        self.assertEqual(stats.counts, {'candidates': 4, 'rows': 3,
+                                        'columns': 1, 'cells': 3})
+
+
+class RenderCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (
+            ('a', (('aa', 11), ('ab', 12))),
+            ('b', (('ba', 21),)),
+        )
+        self.other_data = (
+            ('a', (('aa', 11), ('ab', '12'))),
+            ('b', (('ba', 21),)),
+        )
+
+    def testContentHash(self):
+        self.assertEqual(get_content_hash(self.data),
+                         get_content_hash(dict(self.data)))
+        self.assertNotEqual(get_content_hash(self.data),
+                            get_content_hash(self.other_data))
+        self.assertNotEqual(get_content_hash(self.data),
+                            get_content_hash(self.data, (h, v)))
+        self.assertNotEqual(get_content_hash(self.data, (v, h)),
+                            get_content_hash(self.data, (h, v)))
+
+    def testContentHashDuplicates(self):
+        data = (('a', 1), ('b', 2), ('a', 3))
+        self.assertEqual(get_content_hash(data),
+                         get_content_hash((('a', 3), ('b', 2))))
+        self.assertNotEqual(get_content_hash(data),
+                            get_content_hash((('b', 2), ('a', 3))))
+
+    def testContentHashLevels(self):
+        datadicts = (
+            (('a', 1), ('b', (('c', 2),))),
+            (('a', 1), ('b', (('c', Decimal(2)),))),
+            (('a', 1), ('b', ())),
+            (('a', 1), ('b', None)),
+            (('a', (('c', 2),)), ('b', (('c', 2),))),
+            (('a', (('c', 2),)), ('b', (('c', 2.),))),
+            (('a', (('c', 2),)), ('b', (('c', True),))),
+            (('a', (('c', 2),)), ('b', (('c', '2'),))),
+            ((Decimal(1), (('c', 2),)), ('b', (('c', 2),))),
+        )
+        hashes = set(get_content_hash(d, (v, v)) for d in datadicts)
+        self.assertEqual(len(hashes), len(datadicts))
+        self.assertEqual(
+            get_content_hash([['a', ([1, 2],)], ['b', (['c', 2],)]]),
+            get_content_hash((('a', ((1, 2),)), ('b', (('c', 2),)))))
+
+    def testContentHashCollision(self):
+        data = (('a', '1'), ('b', 2))
+        other_data = (('a', "1,str:'b'=int:2"),)
+        self.assertNotEqual(get_content_hash(data, (h,)),
+                            get_content_hash(other_data, (h,)))
+        cache = RenderCache()
+        self.assertEqual(cache.get_html(data, (h,)),
+                         build_table_dict(data, (h,)).generate_html())
+        self.assertEqual(cache.get_html(other_data, (h,)),
+                         build_table_dict(other_data, (h,)).generate_html())
+
+    def testContentHashEqualKeys(self):
+        for key, other_key in ((0.0, -0.0),
+                               (Decimal('1.0'), Decimal('1.00'))):
+            data = (('a', ((key, 1),)), ('b', ((other_key, 2),)))
+            other_data = (('a', ((key, 1),)), ('b', ((key, 2),)))
+            self.assertNotEqual(get_content_hash(data, (v, v)),
+                                get_content_hash(other_data, (v, v)))
+            cache = RenderCache()
+            for datadict in (other_data, data):
+                self.assertEqual(
+                    cache.get_html(datadict, (v, v)),
+                    build_table_dict(datadict, (v, v)).generate_html())
+
+    def testHitsAndMisses(self):
+        cache = RenderCache()
+        html = cache.get_html(self.data)
+        self.assertEqual(html,
+                         build_optimal_table_dict(self.data).generate_html())
+        self.assertEqual(cache.get_html(self.data), html)
+        self.assertEqual(cache.get_html(self.data, (v, h)),
+                         build_table_dict(self.data, (v, h)).generate_html())
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def testEviction(self):
+        cache = RenderCache(max_size=10)
+        cache.set('a', '12345')
+        cache.set('b', '12345')
+        cache.get('a')
+        cache.set('c', '12345')
+        self.assertEqual((cache.get('a'), cache.get('b')), ('12345', None))
+        self.assertEqual(cache.size, 10)
+        cache.set('d', '12345678901')
+        self.assertEqual(len(cache), 2)
+
+    def testDisk(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'cache.sqlite3')
+            cache = RenderCache(path=path)
+            html = cache.get_html(self.data)
+            cache.close()
+            cache = RenderCache(path=path)
+            self.assertEqual(cache.get_html(self.data), html)
+            self.assertEqual((cache.disk_hits, cache.misses), (1, 0))
+            self.assertEqual(cache.get_html(self.data), html)
+            self.assertEqual(cache.hits, 1)
+            cache.clear()
+            self.assertIsNone(cache.get(get_content_hash(self.data)))
+            cache.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def testDiskEviction(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'cache.sqlite3')
+            connection = sqlite3.connect(path)
+            with connection:
+                connection.execute('CREATE TABLE html_tables '
+                                   '(key TEXT PRIMARY KEY, html TEXT)')
+            connection.close()
+            cache = RenderCache(max_size=0, path=path, max_disk_size=10)
+            cache.set('a', '12345')
+            cache.set('b', '12345')
+            cache.get('a')
+            cache.set('c', '12345')
+            self.assertEqual((cache.get('a'), cache.get('b')),
+                             ('12345', None))
+            self.assertEqual(cache.disk_size, 10)
+            cache.set('d', '12345678901')
+            self.assertIsNone(cache.get('d'))
+            cache.close()
+            cache = RenderCache(max_size=0, path=path, max_disk_size=10)
+            self.assertEqual(cache.disk_size, 10)
+            cache.set('e', '1234')
+            self.assertEqual((cache.get('a'), cache.get('c'), cache.get('e')),
+                             ('12345', None, '1234'))
+            cache.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def testThreads(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = RenderCache(path=os.path.join(directory, 'cache.sqlite3'))
+            html = cache.get_html(self.data)
+            cache.clear()
+            with ThreadPoolExecutor(4) as executor:
+                results = list(executor.map(
+                    lambda _: cache.get_html(self.data), range(20)))
+            self.assertEqual(results, [html] * 20)
+            self.assertEqual(cache.hits + cache.misses, 21)
+            cache.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+def get_html_cells(html):
+    """
+    Returns the ``(text, colspan, rowspan)`` of the cells of each row.
+    """
+
+    rows = []
+    for row in html.split('<tr>')[1:]:
+        cells = []
+        for attrs, text in re.findall(r'<t[dh]([^>]*)>(.*?)</t[dh]>', row):
+            attrs = dict(re.findall(r'(\w+)="(\d+)"', attrs))
+            cells.append((text, int(attrs.get('colspan', 1)),
+                          int(attrs.get('rowspan', 1))))
+        rows.append(cells)
+    return rows
+
+
+def get_grid_cells(grid):
+    rows = []
+    for i, headers in enumerate(grid['horizontal_headers']):
+        cells = []
+        if i == 0 and grid['corner']:
+            cells.append(('', grid['corner'][0], grid['corner'][1]))
+        rows.append(cells + [('%s' % header, colspan, rowspan)
+                             for header, colspan, rowspan in headers])
+    width = grid['width']
+    for i, headers in enumerate(grid['vertical_headers']):
+        rows.append(
+            [('%s' % header, colspan, rowspan)
+             for header, colspan, rowspan in headers]
+            + [('-' if d is None else '%s' % d, 1, 1)
+               for d in grid['data'][i * width:(i + 1) * width]])
+    return rows
+
+
+class GridTest(unittest.TestCase):
+    def setUp(self):
+        self.datadicts = (
+            (('a', 1), ('b', 2)),
+            (('a', (('aa', 11), ('ab', 12))), ('b', (('ba', 21),))),
+            (('a', (('aa', 11), ('ab', 12))), ('b', 2)),
+            (('1902', (('maison', (('hommes', 80), ('femmes', 40.5))),
+                       ('quartier', (('hommes', None),)))),
+             ('1903', (('maison', (('hommes', 'x'),)),))),
+        )
+
+    def testSpans(self):
+        for data in self.datadicts:
+            for structure in get_all_structures(data):
+                table = build_table_dict(data, structure)
+                self.assertEqual(get_grid_cells(table.get_grid()),
+                                 get_html_cells(table.generate_html()))
+
+    def testJson(self):
+        table = build_table_dict(self.datadicts[-1], (v, h, h))
+        grid = json.loads(table.generate_json())
+        self.assertEqual(grid, table.get_grid())
+        self.assertEqual(grid['width'], 4)
+        self.assertEqual(grid['data'][:3], [80, 40.5, None])
+        self.assertLess(len(table.generate_json()),
+                        len(table.generate_html()))
+
+    def testNonFinite(self):
+        nan = float('nan')
+        inf = float('inf')
+        table = build_table_dict(
+            (('a', nan), ('b', inf), ('c', -inf), (nan, 1.5)), (h,))
+        grid = json.loads(table.generate_json())
+        self.assertEqual(grid['data'], [None, None, None, 1.5])
+        self.assertEqual(grid['horizontal_headers'][0][3], [None, 1, 1])
+
+
+class RecordsTest(unittest.TestCase):
+    def testMixedLevels(self):
+        records = iter([(('a', 'aa'), 11), (('b',), 2), (('a', 'ab'), 12)])
+        table = build_table_dict_from_records(records, (h, h))
+        self.assertEqual(
+            table.generate_html(),
+            build_table_dict((('a', (('aa', 11), ('ab', 12))), ('b', 2)),
+                             (h, h)).generate_html())
+
+    def testDuplicates(self):
+        records = [(('a', 'aa'), 11), (('b', 'ba'), 21), (('a', 'aa'), 10),
+                   (('b',), 2), (('b', 'bb'), 22)]
+        for structure in ((v, h), (h, v)):
+            table = build_table_dict_from_records(records, structure)
+            self.assertEqual(
+                table.generate_html(),
+                build_table_dict((('a', (('aa', 10),)), ('b', (('bb', 22),))),
+                                 structure).generate_html())
+
+    def testPatches(self):
+        table = build_table_dict_from_records(
+            [(('a', 'aa'), 11), (('b', 'ba'), 21)], (v, h))
+        table.track_changes()
+        table['b']['ba'] = 20
+        self.assertEqual(table.get_patches(), [(1, 1, '<td>20</td>')])
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class ArrayTest(unittest.TestCase):
+    def setUp(self):
+        self.array = numpy.arange(12).reshape(2, 3, 2)
+        self.labels = (['1902', '1903'], ['a', 'b', 'c'],
+                       numpy.array([10, 20]))
+        self.data = self.get_data(self.array)
+
+    def get_data(self, array):
+        def get_value(value):
+            value = value.item()
+            return None if value != value else value
+
+        return tuple(
+            (year, tuple(
+                (place, tuple((int(age), get_value(array[i, j, k]))
+                              for k, age in enumerate(self.labels[2])))
+                for j, place in enumerate(self.labels[1])))
+            for i, year in enumerate(self.labels[0]))
+
+    def testStructures(self):
+        array = self.array / 3.
+        array[1, 2, 0] = numpy.nan
+        data = self.get_data(array)
+        self.assertIsNone(data[1][1][2][1][0][1])
+        for structure in get_all_structures(self.data):
+            self.assertEqual(
+                render_array(self.array, self.labels, structure),
+                build_table_dict(self.data, structure).generate_html())
+            self.assertEqual(
+                render_array(array, self.labels, structure),
+                build_table_dict(data, structure).generate_html())
+
+    def testMissing(self):
+        labels = (['a', 'b'], ['x', 'y'])
+        array = numpy.array([[1.5, numpy.nan], [2., 3.]])
+        data = (('a', (('x', 1.5), ('y', None))),
+                ('b', (('x', 2.), ('y', 3.))))
+        self.assertEqual(render_array(array, labels, (v, h)),
+                         build_table_dict(data, (v, h)).generate_html())
+        array = numpy.ma.masked_array([[1, 0], [2, 3]], mask=[[0, 1], [0, 0]])
+        data = (('a', (('x', 1), ('y', None))),
+                ('b', (('x', 2), ('y', 3))))
+        self.assertEqual(render_array(array, labels, (v, h)),
+                         build_table_dict(data, (v, h)).generate_html())
+
+    def testCellFormat(self):
+        cell_format = CellFormat(types={int: '%03d'.__mod__})
+        for structure in get_all_structures(self.data):
+            self.assertEqual(
+                render_array(self.array, self.labels, structure,
+                             cell_format),
+                build_table_dict(self.data, structure).generate_html(
+                    cell_format=cell_format))
+
+    def testVectorizedFormat(self):
+        labels = (['a', 'b'], ['x', 'y'])
+        masked = numpy.ma.masked_array([[1, 0], [2, 3]],
+                                       mask=[[0, 1], [0, 0]])
+        floats = numpy.array([[0.1, numpy.nan], [1e16, -0.]])
+        booleans = numpy.array([[True, False], [False, True]])
+        complexes = numpy.array([[1 + 2j, 0], [-.5j, 1]])
+        cell_formats = (None, CellFormat(missing=''),
+                        CellFormat(types={float: '{:.1f}'.format}),
+                        CellFormat(columns={('y',): '<{}>'.format}))
+        for array in (masked, floats, booleans, complexes):
+            data = tuple(
+                (row_label, tuple(
+                    (column_label, None if masked_value is numpy.ma.masked
+                     or masked_value != masked_value
+                     else masked_value.item())
+                    for column_label, masked_value in zip(labels[1], row)))
+                for row_label, row in zip(labels[0],
+                                          numpy.ma.asanyarray(array)))
+            for cell_format in cell_formats:
+                for structure in ((v, h), (h, v)):
+                    self.assertEqual(
+                        render_array(array, labels, structure, cell_format),
+                        build_table_dict(data, structure).generate_html(
+                            cell_format=cell_format))
+
+    def testInvalid(self):
+        with self.assertRaises(ValueError):
+            render_array(self.array, self.labels[:2], (v, h))
+        with self.assertRaises(ValueError):
+            render_array(self.array, (['a'], ['b'], ['c']), (v, h, h))
+
+
+class CellFormatTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (
+            ('<b>', (('price', 1.5), ('name', 'R&D'), ('count', 3))),
+            ('c', (('price', 2.25), ('count', None))),
+        )
+
+    def testDefault(self):
+        for structure in get_all_structures(self.data):
+            table = build_table_dict(self.data, structure)
+            self.assertEqual(
+                table.generate_html(cell_format=CellFormat(escape=False)),
+                table.generate_html())
+
+    def testEscape(self):
+        html = build_table_dict(self.data, (v, h)).generate_html(
+            cell_format=CellFormat())
+        self.assertIn('<th colspan="1">&lt;b&gt;</th>', html)
+        self.assertIn('<td>R&amp;D</td>', html)
+        self.assertNotIn('<b>', html)
+
+    def testFormatters(self):
+        cell_format = CellFormat(
+            missing='<i>n/a</i>', types={float: '{:.1f}'.format},
+            columns={('count',): lambda count: '%s items' % count})
+        table = build_table_dict(self.data, (v, h))
+        html = table.generate_html(cell_format=cell_format)
+        self.assertIn('<td>1.5</td><td>R&amp;D</td><td>3 items</td>', html)
+        self.assertIn('<td>2.2</td><td><i>n/a</i></td><td><i>n/a</i></td>',
+                      html)
+        self.assertEqual(table.generate_html(cell_format=cell_format), html)
+        self.assertNotIn('items', table.generate_html())
+
+    def testRenderPaths(self):
+        cell_format = CellFormat(
+            missing='<i>n/a</i>', types={float: '{:.1f}'.format},
+            columns={('count',): lambda count: '%s items' % count})
+        for structure in get_all_structures(self.data):
+            table = build_table_dict(self.data, structure)
+            html = table.generate_html(cell_format=cell_format)
+            self.assertEqual(
+                table.generate_html_window(cell_format=cell_format), html)
+            self.assertEqual(
+                table.generate_html_sparse(cell_format=cell_format), html)
+            with ThreadPoolExecutor(2) as executor:
+                self.assertEqual(table.generate_html_parallel(
+                    2, executor, cell_format=cell_format), html)
+            if asyncio is not None:
+                for cells in (1, 2, 1000):
+                    self.assertEqual(''.join(run_async_iter(
+                        table.generate_html_async(
+                            cells, cell_format=cell_format))), html)
+
+    def testPatches(self):
+        cell_format = CellFormat(columns={('count',): '%s items'.__mod__})
+        table = build_table_dict(self.data, (v, h))
+        table.track_changes()
+        table['c']['count'] = 4
+        self.assertEqual(table.get_patches(cell_format),
+                         [(1, 2, '<td>4 items</td>')])
+        table['c']['count'] = None
+        (row, html), = table.get_row_patches(cell_format)
+        self.assertEqual(html, '<tr><th colspan="1">c</th><td>2.25</td>'
+                               '<td>-</td><td>-</td></tr>')
+
+    def testLayoutCache(self):
+        table = build_table_dict(self.data, (v, h))
+        for _ in range(10):
+            table.generate_html(cell_format=CellFormat())
+            table.generate_html(cell_format=CellFormat(escape=False))
+        self.assertEqual(
+            len([key for key in table._cache if key[0] == 'layout']), 2)
+
+    def testFormatHeader(self):
+        class UpperCellFormat(CellFormat):
+            def format_header(self, header):
+                return super(UpperCellFormat, self).format_header(
+                    header).upper()
+
+        cell_format = UpperCellFormat()
+        for structure in get_all_structures(self.data):
+            table = build_table_dict(self.data, structure)
+            html = table.generate_html(cell_format=cell_format)
+            self.assertIn('>PRICE</th>', html)
+            self.assertIn('>&LT;B&GT;</th>', html)
+            self.assertEqual(
+                table.generate_html_window(cell_format=cell_format), html)
+            self.assertNotIn('PRICE',
+                             table.generate_html(cell_format=CellFormat()))
+
+    def testFormatHeaderCache(self):
+        class PrefixCellFormat(CellFormat):
+            def __init__(self, prefix, **kwargs):
+                super(PrefixCellFormat, self).__init__(**kwargs)
+                self.prefix = prefix
+
+            def format_header(self, header):
+                return self.prefix + super(PrefixCellFormat,
+                                           self).format_header(header)
+
+        table = build_table_dict(self.data, (v, h))
+        for _ in range(10):
+            html = table.generate_html(cell_format=PrefixCellFormat('#'))
+            self.assertIn('>#price</th>', html)
+        html = table.generate_html(cell_format=PrefixCellFormat('@'))
+        self.assertIn('>@price</th>', html)
+        self.assertNotIn('>#price</th>', html)
+        # Only the last custom layout is kept.
+        self.assertEqual(
+            len([key for key in table._cache
+                 if key[0] == 'layout' and key[-1] == 'format_header']), 1)
+
+
+FREE_THREADED = not getattr(sys, '_is_gil_enabled', lambda: True)()
+
+
+class FrozenTest(unittest.TestCase):
+    def setUp(self):
+        self.data = tuple(
+            ('%s' % i, tuple(('%s' % j, i * j) for j in range(40)))
+            for i in range(100))
+        self.table = build_table_dict(self.data, (v, h))
+        self.html = self.table.generate_html()
+        self.table.freeze()
+
+    def testMutations(self):
+        for mutate in (
+                lambda: self.table.__setitem__('a', 1),
+                lambda: self.table['1'].__setitem__('1', 2),
+                lambda: self.table.__delitem__('1'),
+                lambda: self.table.pop('1'),
+                lambda: self.table['1'].popitem(),
+                lambda: self.table.update(a=1),
+                lambda: self.table.setdefault('a', 1),
+                lambda: self.table.clear()):
+            self.assertRaises(TypeError, mutate)
+        self.assertTrue(self.table.frozen)
+        self.assertEqual(self.table.generate_html(), self.html)
+
+    def testDeepCopy(self):
+        table = copy.deepcopy(self.table)
+        self.assertFalse(table.frozen)
+        table['1']['1'] = 0
+        self.assertNotEqual(table.generate_html(), self.html)
+
+    def render(self, threads, renders):
+        results = []
+
+        def target():
+            for _ in range(renders):
+                results.append(self.table.generate_html())
+
+        threads = [threading.Thread(target=target) for _ in range(threads)]
+        start = default_timer()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return default_timer() - start, results
+
+    def testConcurrentRendering(self):
+        cache = dict(self.table._cache)
+        seconds, results = self.render(8, 10)
+        self.assertEqual(results, [self.html] * 80)
+        self.assertEqual(self.table._cache, cache)
+
+    @unittest.skipUnless(FREE_THREADED, 'requires a free-threaded build')
+    def testScaling(self):
+        one_thread = min(self.render(1, 20)[0] for _ in range(3))
+        four_threads = min(self.render(4, 20)[0] for _ in range(3))
+        # Four times the work in about the same time.
+        self.assertLess(four_threads, one_thread * 2)
+
+
+def datadict_to_records(datadict, path=()):
+    for k, child in datadict:
+        if isinstance(child, tuple):
+            for record in datadict_to_records(child, path + (k,)):
+                yield record
+        else:
+            yield path + (k,), child
+
+
+class DiskTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (
+            ('1902', (
+                ('maison', (('hommes', 80), ('femmes', Decimal('40.5')))),
+                ('quartier', (('hommes', True), ('femmes', None))),
+            )),
+            ('1903', (
+                ('maison', (('hommes', '<70>'), ('femmes', 2 ** 70))),
+                ('quartier', (('hommes', 5.5),)),
+            )),
+            ('total', 300),
+        )
+
+    def testStructures(self):
+        for structure in get_all_structures(self.data):
+            table = build_disk_table_dict(
+                datadict_to_records(self.data), structure, rows_per_band=1,
+                batch_size=2)
+            expected = build_table_dict(self.data, structure)
+            self.assertEqual(table.generate_html(), expected.generate_html())
+            self.assertEqual(table.get_ugliness(), expected.get_ugliness())
+            self.assertEqual(table.generate_html(cell_format=CellFormat()),
+                             expected.generate_html(cell_format=CellFormat()))
+
+    def testFile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'leaves.sqlite3')
+            records = [(('a', 'x'), 1), (('b', 'x'), 2), (('a', 'x'), 3)]
+            with build_disk_table_dict(records, (v, h), path,
+                                       rows_per_band=1) as table:
+                self.assertEqual(table.rows_per_band, 1)
+                self.assertEqual(table['a'].rows_per_band, 1)
+                self.assertEqual(table['a']['x'], 3)
+                self.assertEqual(list(table), ['a', 'b'])
+                stats = Stats()
+                self.assertEqual(
+                    table.generate_html(stats),
+                    build_table_dict((('a', (('x', 3),)), ('b', (('x', 2),))),
+                                     (v, h)).generate_html())
+                self.assertEqual(stats.counts['rows'], 2)
+                self.assertTrue(os.path.exists(path))
+            self.assertRaises(sqlite3.ProgrammingError,
+                              lambda: table['b']['x'])
+        finally:
+            shutil.rmtree(directory)
+
+    @unittest.skipIf(asyncio is None,
+                     'asyncio rendering requires Python 3.6+')
+    def testAsync(self):
+        for structure in get_all_structures(self.data):
+            expected = build_table_dict(self.data, structure).generate_html()
+            for offload in (False, True):
+                table = build_disk_table_dict(
+                    datadict_to_records(self.data), structure,
+                    rows_per_band=1)
+                with table:
+                    chunks = run_async_iter(
+                        table.generate_html_async(2, offload))
+                    self.assertEqual(''.join(chunks), expected)
+                    for chunk in chunks:
+                        self.assertLessEqual(chunk.count('<td>'), 2)
+                    # Data was extracted band by band.
+                    self.assertNotIn(('data', structure), table._cache)
+
+    def testExports(self):
+        for structure in get_all_structures(self.data):
+            expected = build_table_dict(self.data, structure)
+            table = build_disk_table_dict(
+                datadict_to_records(self.data), structure, rows_per_band=1)
+            table._leaves.page_size = table._leaves.max_pages = 1
+            with table, ThreadPoolExecutor(2) as executor:
+                self.assertEqual(table.get_grid(), expected.get_grid())
+                self.assertEqual(table.generate_json(),
+                                 expected.generate_json())
+                for compress in (False, True):
+                    self.assertEqual(table.generate_html_sparse(compress),
+                                     expected.generate_html_sparse(compress))
+                self.assertEqual(table.generate_html_parallel(2, executor),
+                                 expected.generate_html())
+                # Data was extracted band by band, and not kept.
+                self.assertFalse([key for key in table._cache
+                                  if key[0] == 'data'])
+                self.assertLessEqual(len(table._leaves.pages), 1)
+                # Nested tables keep nothing.
+                tables = list(table._children)
+                while tables:
+                    nested = tables.pop()
+                    if nested is not None:
+                        self.assertIsNone(nested._cache)
+                        tables.extend(nested._children)
+
+    def testThreads(self):
+        table = build_disk_table_dict(datadict_to_records(self.data),
+                                      (v, v, h))
+        with table, ThreadPoolExecutor(2) as executor:
+            self.assertEqual(
+                executor.submit(table.generate_html).result(),
+                build_table_dict(self.data, (v, v, h)).generate_html())
+
+
+class StructureMemoTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (
+            ('a', (('aa', 11), ('ab', 12), ('ac', 13))),
+            ('b', (('ba', 21),)),
+        )
+        self.other_data = (
+            ('a', (('aa', 1), ('ab', 2), ('ac', 3))),
+            ('b', (('ba', 4),)),
+        )
+
+    def testMemo(self):
+        memo = StructureMemo()
+        structure = get_optimal_structure(self.data, memo=memo)
+        self.assertEqual(structure,
+                         get_optimal_structure(self.data, memo=None))
+        self.assertEqual(get_optimal_structure(self.other_data, memo=memo),
+                         structure)
+        self.assertEqual((memo.hits, memo.misses), (1, 1))
+        self.assertEqual(memo.items(),
+                         [(get_shape_fingerprint(self.data), structure)])
+        get_optimal_structure((('a', 1),), memo=memo)
+        self.assertEqual(len(memo), 2)
+        memo.clear()
+        self.assertEqual((len(memo), memo.hits, memo.misses), (0, 0, 0))
+
+    def testReplacedLevel(self):
+        # The nested value of ``'a'`` is replaced, but still counts
+        # in the number of levels.
+        data = (('a', (('x', 1),)), ('a', 2))
+        other_data = (('a', 3),)
+        memo = StructureMemo()
+        for datadict in (data, other_data):
+            self.assertEqual(get_optimal_structure(datadict, memo=memo),
+                             get_optimal_structure(datadict, memo=None))
+        self.assertEqual(len(memo), 2)
+
+    def testStats(self):
+        memo = StructureMemo()
+        stats = Stats()
+        get_optimal_structure(self.data, stats=stats, memo=memo)
+        self.assertEqual(stats.counts['candidates'], 4)
+        get_optimal_structure(self.other_data, stats=stats, memo=memo)
+        self.assertEqual(stats.counts['candidates'], 4)
+        self.assertEqual((memo.hits, memo.misses), (1, 1))
+        get_optimal_structure(self.data, stats=stats, memo=None)
+        self.assertEqual(stats.counts['candidates'], 8)
+
+    def testEviction(self):
+        memo = StructureMemo(max_size=1)
+        get_optimal_structure(self.data, memo=memo)
+        get_optimal_structure((('a', 1),), memo=memo)
+        get_optimal_structure(self.other_data, memo=memo)
+        self.assertEqual((len(memo), memo.hits, memo.misses), (1, 0, 3))
+
+    def testCustomKey(self):
+        memo = StructureMemo()
+        get_optimal_structure(self.data, key=get_width, memo=memo)
+        self.assertEqual(len(memo), 0)
+
+    def testDefault(self):
+        OPTIMAL_STRUCTURES.clear()
+        build_optimal_table_dict(self.data)
+        build_optimal_table_dict(self.other_data)
+        self.assertEqual(OPTIMAL_STRUCTURES.hits, 1)
+
+
+class ParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.data = tuple(
+            ('%s' % i, tuple(
+                ('%s' % j, tuple(('%s' % k, i * j * k or None)
+                                 for k in range(3) if k or i != j))
+                for j in range(5)))
+            for i in range(8))
+
+    def testThreads(self):
+        with ThreadPoolExecutor(3) as executor:
+            for structure in get_all_structures(self.data):
+                table = build_table_dict(self.data, structure)
+                for workers in (1, 2, 20):
+                    self.assertEqual(
+                        table.generate_html_parallel(workers, executor),
+                        table.generate_html())
+
+    def testDefaultExecutor(self):
+        table = build_table_dict(self.data, (v, v, h))
+        cell_format = CellFormat(missing='')
+        self.assertEqual(table.generate_html_parallel(2),
+                         table.generate_html())
+        self.assertEqual(
+            table.generate_html_parallel(cell_format=cell_format),
+            table.generate_html(cell_format=cell_format))
+        executor = _get_parallel_executor()
+        self.assertIs(_get_parallel_executor(), executor)
+        self.assertIsInstance(executor, ThreadPoolExecutor if FREE_THREADED
+                              else ProcessPoolExecutor)
+
+    def testConcurrentBands(self):
+        table = build_table_dict(self.data, (v, v, h))
+        # Each of the 2 threads waits for the other one in its first band,
+        # so this fails if bands are not rendered concurrently.
+        barrier = threading.Barrier(2, timeout=10)
+        local = threading.local()
+
+        def format_int(d):
+            if not getattr(local, 'waited', False):
+                local.waited = True
+                barrier.wait()
+            return '%s' % d
+
+        cell_format = CellFormat(types={int: format_int})
+        with ThreadPoolExecutor(2) as executor:
+            self.assertEqual(
+                table.generate_html_parallel(2, executor, cell_format),
+                table.generate_html(cell_format=CellFormat()))
+
+    def testProcesses(self):
+        table = build_table_dict(self.data, (v, v, h))
+        cell_format = CellFormat(missing='')
+        with ProcessPoolExecutor(2) as executor:
+            self.assertEqual(
+                table.generate_html_parallel(2, executor, cell_format),
+                table.generate_html(cell_format=cell_format))
+
+
+class SparseTest(unittest.TestCase):
+    def setUp(self):
+        self.data = (
+            ('1902', (
+                ('maison', (('hommes', 80), ('femmes', None))),
+                ('quartier', (('garçons', 12),)),
+            )),
+            ('1903', (
+                ('maison', (('femmes', 38),)),
+                ('prison', 4),
+            )),
+        )
+
+    def testSameHtml(self):
+        for structure in get_all_structures(self.data):
+            table = build_table_dict(self.data, structure)
+            self.assertEqual(table.generate_html_sparse(),
+                             table.generate_html())
+
+    def testCompress(self):
+        table = build_table_dict(self.data, (v, h, h))
+        html = table.generate_html_sparse(compress=True)
+        self.assertIn('<th colspan="1">1902</th><td>80</td><td>-</td>'
+                      '<td>12</td><td colspan="2">-</td></tr>', html)
+        self.assertEqual(html.replace('<td colspan="2">-</td>',
+                                      '<td>-</td><td>-</td>'),
+                         table.generate_html())
+
+    def testDataChange(self):
+        table = build_table_dict(self.data, (v, v, h))
+        table.generate_html_sparse()
+        table['1903']['maison']['femmes'] = 39
+        self.assertEqual(table.generate_html_sparse(), table.generate_html())
+        self.assertIn('<td>39</td>', table.generate_html_sparse())
+
+
 if __name__ == '__main__':
     unittest.main()